@@ -0,0 +1,75 @@
+"""
+关键词近似匹配基准：比较删除变体索引与逐条计算编辑距离的单条消息耗时。
+用法：python bench_keywords.py [关键词数 ...]（默认 1000 10000）
+"""
+import random
+import sys
+import time
+from modules.keyword_matcher import KeywordMatcher, MODE_APPROX, edit_distance, PREFILTER_STATS, prefilter_stats
+
+# 常用汉字区间里取一段作字符池，关键词 4~8 个字
+CHARS = [chr(c) for c in range(0x4E00, 0x4E00 + 400)]
+
+def random_word(rng):
+    return "".join(rng.choice(CHARS) for _ in range(rng.randint(4, 8)))
+
+def typo(rng, word):
+    """随机替换、删除或插入一个字"""
+    i = rng.randrange(len(word))
+    op = rng.choice(("replace", "delete", "insert"))
+    if op == "replace":
+        return word[:i] + rng.choice(CHARS) + word[i + 1:]
+    if op == "delete":
+        return word[:i] + word[i + 1:]
+    return word[:i] + rng.choice(CHARS) + word[i:]
+
+def naive_match(rows, text):
+    for row in rows:
+        if edit_distance(text, row["keyword"]) <= row["max_distance"]:
+            return row
+    return None
+
+def per_call(func, queries, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for q in queries:
+            func(q)
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1e6
+
+def bench(size, rng, queries=200):
+    words = list(dict.fromkeys(random_word(rng) for _ in range(size)))
+    rows = [{"keyword": w, "reply": "", "fuzzy": MODE_APPROX, "max_distance": 1} for w in words]
+    start = time.perf_counter()
+    matcher = KeywordMatcher(rows)
+    build_ms = (time.perf_counter() - start) * 1000
+    # 一半是关键词的错字写法，一半是不相关的消息（其中一部分是长消息，由预筛直接跳过）
+    texts = [typo(rng, rng.choice(words)) for _ in range(queries // 2)]
+    texts += [random_word(rng) * rng.choice((1, 1, 3)) for _ in range(queries - len(texts))]
+
+    # 逐条比较太慢，只取一部分消息测耗时并核对结果
+    sample = texts[::10]
+    mismatches = sum(matcher.match(t) is not naive_match(rows, t) for t in sample)
+    PREFILTER_STATS.update(messages=0, rejected=0)
+    indexed = per_call(matcher.match, texts, 5)
+    skipped = prefilter_stats()["hit_rate"]
+    naive = per_call(lambda t: naive_match(rows, t), sample, 1)
+    print(f"{len(rows):>6} 个关键词  构建 {build_ms:8.1f} ms  "
+          f"索引 {indexed:9.1f} µs/条  逐条比较 {naive:10.1f} µs/条  "
+          f"加速 {naive / indexed:6.1f}x  预筛跳过 {skipped:.0%}  结果不一致 {mismatches}")
+
+def bench_prefilter(size, rng, queries=2000):
+    """精准 + 包含关键词，消息为普通聊天（大多不命中），看预筛跳过的比例"""
+    rows = [{"keyword": random_word(rng), "reply": "", "fuzzy": rng.choice((0, 0, 1))} for _ in range(size)]
+    matcher = KeywordMatcher(rows)
+    texts = ["".join(rng.choice(CHARS) for _ in range(rng.randint(2, 30))) for _ in range(queries)]
+    PREFILTER_STATS.update(messages=0, rejected=0)
+    cost = per_call(matcher.match, texts, 3)
+    print(f"{size:>6} 个精准/包含关键词  {cost:6.1f} µs/条  预筛跳过 {prefilter_stats()['hit_rate']:.0%}")
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or [1000, 10000]
+    rng = random.Random(42)
+    for size in sizes:
+        bench(size, rng)
+    for size in sizes:
+        bench_prefilter(size, rng)
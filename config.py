@@ -41,4 +41,57 @@ for k, v in GROUPS_TMP.items():
         except Exception:
             pass
 
+# 定时推送：每轮最多处理的到期条数；最长睡眠秒数（兜底发现其他进程写入的修改）
+SCHEDULE_BATCH_LIMIT = int(os.getenv("SCHEDULE_BATCH_LIMIT", "200"))
+SCHEDULE_MAX_SLEEP = int(os.getenv("SCHEDULE_MAX_SLEEP", "300"))
+# 一轮没有认领到任何到期消息时的最短睡眠秒数（防止空转）
+SCHEDULE_MIN_SLEEP = float(os.getenv("SCHEDULE_MIN_SLEEP", "1"))
+# SQLite 跨进程缓存同步的轮询间隔（秒）；Postgres 使用 LISTEN/NOTIFY 实时推送
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "2"))
+# 多实例分片：实例心跳租约秒数（超时视为下线，群组重新分配）；
+# 认领到期定时消息后的租约秒数（实例中途崩溃时，过期后由其他实例重新推送）
+SHARD_LEASE_TTL = int(os.getenv("SHARD_LEASE_TTL", "30"))
+SCHEDULE_CLAIM_LEASE = int(os.getenv("SCHEDULE_CLAIM_LEASE", "300"))
+# 推送时间摆放方式：immediate 到点即发；spread 按定时消息 ID 把同周期的消息
+# 确定性地错开到整个周期内，避免同一秒集中推送
+SCHEDULE_PLACEMENT = os.getenv("SCHEDULE_PLACEMENT", "immediate")
+# 同时推送的群组数上限（同一群内仍按顺序推送）
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+# 推送时“删除上一条”与发送新消息并行（设为 0 恢复先删后发，便于对比耗时）
+SCHEDULE_PIPELINE = os.getenv("SCHEDULE_PIPELINE", "1") != "0"
+
+# 发件箱 worker：并发循环数、每批认领条数、每批每个群最多认领条数、认领租约秒数、最多尝试次数、空闲轮询间隔（秒）
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_CHAT_BATCH = int(os.getenv("OUTBOX_CHAT_BATCH", "10"))
+OUTBOX_LEASE = int(os.getenv("OUTBOX_LEASE", "120"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+
+# 延时删除：每批取出的条数、空闲时的轮询间隔（秒）
+DELETION_BATCH = int(os.getenv("DELETION_BATCH", "100"))
+DELETION_POLL_INTERVAL = float(os.getenv("DELETION_POLL_INTERVAL", "5"))
+
+# 关键词自动回复防刷屏：每个群 KEYWORD_CHAT_WINDOW 秒内最多回复 KEYWORD_CHAT_MAX_REPLIES 次（0 为不限），
+# 为全局设置、对所有群相同；单个关键词的冷却秒数存在 keywords.cooldown，在关键词设置中配置
+KEYWORD_CHAT_WINDOW = float(os.getenv("KEYWORD_CHAT_WINDOW", "60"))
+KEYWORD_CHAT_MAX_REPLIES = int(os.getenv("KEYWORD_CHAT_MAX_REPLIES", "20"))
+# 关键词匹配前的文本归一化步骤（逗号分隔，按顺序执行，留空则不归一化）：
+# nfkc 全角/半角统一、casefold 忽略大小写、t2s 繁体转简体（需安装 opencc）、space 合并空白
+KEYWORD_NORMALIZE = os.getenv("KEYWORD_NORMALIZE", "nfkc,casefold,space")
+# 关键词命中统计在内存中累计，每隔多少秒批量写入数据库
+KEYWORD_STATS_FLUSH_INTERVAL = float(os.getenv("KEYWORD_STATS_FLUSH_INTERVAL", "30"))
+
+# Telegram 出站限速：全局每秒条数、每个群每分钟条数、RetryAfter 最多重试次数
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "25"))
+TG_GROUP_PER_MINUTE = float(os.getenv("TG_GROUP_PER_MINUTE", "20"))
+TG_MAX_RETRIES = int(os.getenv("TG_MAX_RETRIES", "3"))
+
+# 外链媒体本地缓存（可选，目录为空则关闭）：缓存目录、容量上限（MB）、
+# 提前多少秒预取即将推送的媒体、预取扫描间隔（秒）
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "")
+MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "512"))
+MEDIA_PREFETCH_AHEAD = int(os.getenv("MEDIA_PREFETCH_AHEAD", "900"))
+MEDIA_PREFETCH_INTERVAL = int(os.getenv("MEDIA_PREFETCH_INTERVAL", "60"))
+
 # 其他自定义配置可继续添加
@@ -1,16 +1,56 @@
+import asyncio
+import datetime
+import json
+import uuid
 import aiosqlite
 import asyncpg
-from config import POSTGRES_DSN
+from config import POSTGRES_DSN, CACHE_SYNC_INTERVAL, OUTBOX_CHAT_BATCH
 
 DB_PATH = "data.db"
 USE_PG = bool(POSTGRES_DSN)
 PG_POOL = None  # 全局 Postgres 连接池
 
+# 定时消息变更回调（调度器据此重新计算下一次推送时间）
+_schedule_listeners = []
+# 关键词变更回调（关键词缓存据此失效）
+_keyword_listeners = []
+
+# 跨进程缓存失效：PG 走 LISTEN/NOTIFY，SQLite 走 cache_events 表 + data_version 轮询
+CACHE_CHANNEL = "lunbo_cache"
+INSTANCE_ID = uuid.uuid4().hex[:12]
+_cache_listener_task = None
+
+# 推送方自己回写的字段，修改它们不需要重新计算推送时间
+SCHEDULE_BOOKKEEPING_FIELDS = {"last_message_id", "last_message_ids", "last_sent_time", "next_fire_at"}
+
+TIME_FMT = "%Y-%m-%d %H:%M:%S"
+
+# 相册：media_group 列存 JSON 数组 [{"type": "photo", "media": "..."}]，最多 10 项；
+# last_message_ids 列存上一次发出的全部消息 ID（JSON 数组，单条消息时为空）
+MEDIA_GROUP_MAX = 10
+
+# 定时消息读缓存：写操作同步更新或失效，稳态下读取不访问数据库
+_schedule_cache = {}     # chat_id -> [row, ...]（与 fetch_schedules 的排序一致）
+_schedule_by_id = {}     # schedule_id -> row（与上面列表共享同一个 dict）
+_schedule_cache_gen = 0  # 每次写入或失效加一，防止写入前发起的查询把旧数据写回缓存
+_schedule_compiled = {}  # schedule_id -> 由缓存行编译出的对象（CompiledSchedule），配置变化时随缓存行一起失效
+SCHEDULE_CACHE_STATS = {"hits": 0, "misses": 0}
+
+# 关键词索引：chat_id -> 启用的关键词行（按 keyword 排序），关键词变更（含其他进程）时失效
+_keyword_index = {}
+_keyword_index_gen = 0   # 每次失效加一，防止失效前发起的查询把旧数据写回索引
+KEYWORD_INDEX_STATS = {"hits": 0, "misses": 0}
+
+def to_db_time(dt):
+    """数据库中的时间统一存为定长文本，保证字符串比较即时间比较"""
+    return dt.strftime(TIME_FMT) if dt else None
+
 # ========================
 # 连接池管理与初始化
 # ========================
-async def _sqlite_conn():
-    return await aiosqlite.connect(DB_PATH)
+def _sqlite_conn():
+    # 返回的连接对象既可 await 也可 async with
+    return aiosqlite.connect(DB_PATH)
 
 async def _pg_conn():
     global PG_POOL
@@ -20,10 +60,268 @@ async def _pg_conn():
         )
     return PG_POOL
 
+# ========================
+# 变更通知
+# ========================
+def on_schedule_change(callback):
+    """
+    注册定时消息变更回调 callback(schedule_id, fields)。
+    fields 为本次修改的字段字典；新增、整体更新或删除时为 None。
+    """
+    _schedule_listeners.append(callback)
+
+def off_schedule_change(callback):
+    try:
+        _schedule_listeners.remove(callback)
+    except ValueError:
+        pass
+
+def _notify_schedule_change(schedule_id, fields=None):
+    for callback in list(_schedule_listeners):
+        try:
+            callback(schedule_id, fields)
+        except Exception as e:
+            print(f"[_notify_schedule_change] ERROR: {e}", flush=True)
+
+def on_keyword_change(callback):
+    """注册关键词变更回调 callback(chat_id)；chat_id 为 None 表示所有群都可能变化"""
+    _keyword_listeners.append(callback)
+
+def off_keyword_change(callback):
+    try:
+        _keyword_listeners.remove(callback)
+    except ValueError:
+        pass
+
+def _notify_keyword_change(chat_id):
+    _invalidate_keyword_index(chat_id)
+    for callback in list(_keyword_listeners):
+        try:
+            callback(chat_id)
+        except Exception as e:
+            print(f"[_notify_keyword_change] ERROR: {e}", flush=True)
+
+async def _publish_change(kind, ref_id=None, chat_id=None, fields=None, ids=None):
+    """把本进程的写操作广播给其他进程；批量写入时用 ids 代替 ref_id"""
+    payload = json.dumps({
+        "src": INSTANCE_ID, "kind": kind, "id": ref_id, "chat_id": chat_id,
+        "fields": sorted(fields) if fields else None,
+        "ids": ids,
+    })
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("SELECT pg_notify($1, $2)", CACHE_CHANNEL, payload)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute(
+                    "INSERT INTO cache_events (src, payload) VALUES (?, ?)",
+                    (INSTANCE_ID, payload)
+                )
+                await db.commit()
+    except Exception as e:
+        print(f"[_publish_change] ERROR: {e}", flush=True)
+
+def _apply_remote_change(payload: str):
+    """应用其他进程广播过来的变更"""
+    try:
+        event = json.loads(payload)
+    except Exception:
+        return
+    if event.get("src") == INSTANCE_ID:
+        return
+    if event.get("kind") == "schedule":
+        fields = event.get("fields")
+        fields = dict.fromkeys(fields) if fields else None
+        if event.get("chat_id") is not None:
+            _cache_schedule_invalidate_chat(event["chat_id"])
+        schedule_ids = event.get("ids") or [event.get("id")]
+        for schedule_id in schedule_ids:
+            if schedule_id is not None:
+                _cache_schedule_forget(schedule_id)
+            _notify_schedule_change(schedule_id, fields)
+    elif event.get("kind") == "keyword":
+        _notify_keyword_change(event.get("chat_id"))
+
+def _apply_remote_reset():
+    """可能漏掉了通知（断线重连等），清空全部缓存"""
+    clear_schedule_cache()
+    _notify_schedule_change(None)
+    _notify_keyword_change(None)
+
+async def _pg_listen_loop():
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(POSTGRES_DSN)
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda c: closed.set())
+            await conn.add_listener(
+                CACHE_CHANNEL, lambda c, pid, channel, payload: _apply_remote_change(payload)
+            )
+            _apply_remote_reset()
+            await closed.wait()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[_pg_listen_loop] ERROR: {e}", flush=True)
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
+
+async def _sqlite_listen_loop(interval):
+    async with _sqlite_conn() as db:
+        cursor = await db.execute("SELECT COALESCE(MAX(id), 0) FROM cache_events")
+        last_id = (await cursor.fetchone())[0]
+        await cursor.close()
+        version = None
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                cursor = await db.execute("PRAGMA data_version")
+                current = (await cursor.fetchone())[0]
+                await cursor.close()
+                if current == version:
+                    continue
+                version = current
+                cursor = await db.execute(
+                    "SELECT id, src, payload FROM cache_events WHERE id > ? ORDER BY id",
+                    (last_id,)
+                )
+                rows = await cursor.fetchall()
+                await cursor.close()
+                for event_id, src, payload in rows:
+                    last_id = event_id
+                    if src != INSTANCE_ID:
+                        _apply_remote_change(payload)
+                # 只保留最近的事件
+                await db.execute("DELETE FROM cache_events WHERE id <= ?", (last_id - 10000,))
+                await db.commit()
+            except Exception as e:
+                print(f"[_sqlite_listen_loop] ERROR: {e}", flush=True)
+
+def start_cache_listener():
+    """启动跨进程缓存失效监听（在 init_db 之后调用）"""
+    global _cache_listener_task
+    if _cache_listener_task is None:
+        if USE_PG:
+            _cache_listener_task = asyncio.create_task(_pg_listen_loop())
+        else:
+            _cache_listener_task = asyncio.create_task(_sqlite_listen_loop(CACHE_SYNC_INTERVAL))
+    return _cache_listener_task
+
+async def stop_cache_listener():
+    global _cache_listener_task
+    task, _cache_listener_task = _cache_listener_task, None
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+# ========================
+# 定时消息缓存
+# ========================
+def schedule_cache_stats():
+    return {
+        **SCHEDULE_CACHE_STATS,
+        "chats": len(_schedule_cache),
+        "rows": len(_schedule_by_id),
+        "compiled": len(_schedule_compiled),
+    }
+
+def _schedule_cache_touch():
+    global _schedule_cache_gen
+    _schedule_cache_gen += 1
+
+def clear_schedule_cache():
+    _schedule_cache_touch()
+    _schedule_cache.clear()
+    _schedule_compiled.clear()
+    _schedule_by_id.clear()
+
+def _cache_schedule_update(schedule_id, fields: dict):
+    """写穿：直接把已写入数据库的字段同步到缓存行"""
+    _schedule_cache_touch()
+    if not set(fields) <= SCHEDULE_BOOKKEEPING_FIELDS:
+        _schedule_compiled.pop(schedule_id, None)
+    row = _schedule_by_id.get(schedule_id)
+    if row is not None:
+        row.update(fields)
+
+def _cache_schedule_drop(schedule_id):
+    _schedule_cache_touch()
+    _schedule_compiled.pop(schedule_id, None)
+    row = _schedule_by_id.pop(schedule_id, None)
+    if row is not None:
+        rows = _schedule_cache.get(row["chat_id"])
+        if rows is not None:
+            _schedule_cache[row["chat_id"]] = [r for r in rows if r["id"] != schedule_id]
+
+def _cache_schedule_forget(schedule_id):
+    """缓存行可能已过期：连同它所在的群列表一起丢弃"""
+    _schedule_cache_touch()
+    _schedule_compiled.pop(schedule_id, None)
+    row = _schedule_by_id.pop(schedule_id, None)
+    if row is not None:
+        _cache_schedule_invalidate_chat(row["chat_id"])
+
+def _cache_schedule_invalidate_chat(chat_id):
+    _schedule_cache_touch()
+    for row in _schedule_cache.pop(chat_id, []):
+        _schedule_by_id.pop(row["id"], None)
+        _schedule_compiled.pop(row["id"], None)
+
+def cached_schedule_object(schedule_id, build):
+    """
+    缓存行编译出的对象：首次调用时用 build(row) 构造，之后直接复用，
+    修改配置（推送方回写的字段除外）或缓存失效时丢弃。该行不在缓存中时返回 None。
+    对象在多处共用，调用方不要修改。
+    """
+    obj = _schedule_compiled.get(schedule_id)
+    if obj is None:
+        row = _schedule_by_id.get(schedule_id)
+        if row is None:
+            return None
+        obj = _schedule_compiled[schedule_id] = build(row)
+    return obj
+
 # ========================
 # 定时消息相关
 # ========================
 async def fetch_schedules(chat_id):
+    rows = _schedule_cache.get(chat_id)
+    if rows is not None:
+        SCHEDULE_CACHE_STATS["hits"] += 1
+        return [dict(row) for row in rows]
+    SCHEDULE_CACHE_STATS["misses"] += 1
+    gen = _schedule_cache_gen
+    rows = await _fetch_schedules_db(chat_id)
+    if rows is not None and gen == _schedule_cache_gen:
+        _schedule_cache[chat_id] = rows
+        for row in rows:
+            _schedule_by_id[row["id"]] = row
+    return [dict(row) for row in rows or []]
+
+async def fetch_schedule(schedule_id):
+    row = _schedule_by_id.get(schedule_id)
+    if row is not None:
+        SCHEDULE_CACHE_STATS["hits"] += 1
+        return dict(row)
+    SCHEDULE_CACHE_STATS["misses"] += 1
+    gen = _schedule_cache_gen
+    row = await _fetch_schedule_db(schedule_id)
+    if row is not None:
+        if gen == _schedule_cache_gen:
+            _schedule_by_id[schedule_id] = row
+        return dict(row)
+    return None
+
+async def _fetch_schedules_db(chat_id):
+    """查询失败返回 None（不写入缓存）"""
     try:
         if USE_PG:
             pool = await _pg_conn()
@@ -45,9 +343,9 @@ async def fetch_schedules(chat_id):
                 return [dict(row) for row in rows]
     except Exception as e:
         print(f"[fetch_schedules] ERROR: {e}", flush=True)
-        return []
+        return None
 
-async def fetch_schedule(schedule_id):
+async def _fetch_schedule_db(schedule_id):
     try:
         if USE_PG:
             pool = await _pg_conn()
@@ -71,41 +369,141 @@ async def fetch_schedule(schedule_id):
         print(f"[fetch_schedule] ERROR: {e}", flush=True)
         return None
 
+async def claim_due_schedules(now, lease_until, limit=100, chat_ids=None):
+    """
+    原子地认领到期的定时消息：把 next_fire_at 推到 lease_until 后返回这些行。
+    多个实例同时认领时每行只会被一个实例拿到（PG 用 FOR UPDATE SKIP LOCKED，
+    SQLite 用 BEGIN IMMEDIATE 串行化）；实例中途崩溃时租约到期后会被重新认领。
+    """
+    now = now if isinstance(now, str) else to_db_time(now)
+    lease_until = lease_until if isinstance(lease_until, str) else to_db_time(lease_until)
+    try:
+        if USE_PG:
+            where = "status=1 AND next_fire_at <= $1"
+            args = [now, lease_until, limit]
+            if chat_ids is not None:
+                where += " AND chat_id = ANY($4::bigint[])"
+                args.append(list(chat_ids))
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(f"""
+                    UPDATE schedules SET next_fire_at=$2
+                    WHERE id IN (
+                        SELECT id FROM schedules WHERE {where}
+                        ORDER BY next_fire_at LIMIT $3
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *
+                """, *args)
+            rows = [dict(row) for row in rows]
+        else:
+            sql = "SELECT * FROM schedules WHERE status=1 AND next_fire_at <= ?"
+            args = [now]
+            if chat_ids is not None:
+                chat_ids = list(chat_ids)
+                if not chat_ids:
+                    return []
+                sql += f" AND chat_id IN ({','.join('?' * len(chat_ids))})"
+                args.extend(chat_ids)
+            sql += " ORDER BY next_fire_at LIMIT ?"
+            args.append(limit)
+            async with _sqlite_conn() as db:
+                db.row_factory = aiosqlite.Row
+                await db.execute("BEGIN IMMEDIATE")
+                cursor = await db.execute(sql, args)
+                rows = [dict(row) for row in await cursor.fetchall()]
+                await cursor.close()
+                if rows:
+                    await db.executemany(
+                        "UPDATE schedules SET next_fire_at=? WHERE id=?",
+                        [(lease_until, row["id"]) for row in rows]
+                    )
+                await db.commit()
+            for row in rows:
+                row["next_fire_at"] = lease_until
+        for row in rows:
+            _cache_schedule_update(row["id"], {"next_fire_at": lease_until})
+        return rows
+    except Exception as e:
+        print(f"[claim_due_schedules] ERROR: {e}", flush=True)
+        return []
+
+async def fetch_next_fire_times(chat_ids=None):
+    """取出启用定时消息的 (id, next_fire_at)，供调度器启动时确定睡眠时长"""
+    try:
+        if USE_PG:
+            sql = "SELECT id, next_fire_at FROM schedules WHERE status=1 AND next_fire_at IS NOT NULL"
+            args = []
+            if chat_ids is not None:
+                sql += " AND chat_id = ANY($1::bigint[])"
+                args.append(list(chat_ids))
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(sql, *args)
+            return [(row["id"], row["next_fire_at"]) for row in rows]
+        else:
+            sql = "SELECT id, next_fire_at FROM schedules WHERE status=1 AND next_fire_at IS NOT NULL"
+            args = []
+            if chat_ids is not None:
+                chat_ids = list(chat_ids)
+                if not chat_ids:
+                    return []
+                sql += f" AND chat_id IN ({','.join('?' * len(chat_ids))})"
+                args.extend(chat_ids)
+            async with _sqlite_conn() as db:
+                cursor = await db.execute(sql, args)
+                rows = await cursor.fetchall()
+                await cursor.close()
+                return [(row[0], row[1]) for row in rows]
+    except Exception as e:
+        print(f"[fetch_next_fire_times] ERROR: {e}", flush=True)
+        return []
+
 async def add_schedule(chat_id, text, media_url='', media_type='', button_text='', button_url='',
                       repeat_seconds=0, time_period='', start_date='', end_date='',
-                      status=1, remove_last=0, pin=0, last_message_id=None):
+                      status=1, remove_last=0, pin=0, last_message_id=None, media_group=''):
+    # 新增的定时消息立即交给调度器计算真正的推送时间
+    next_fire_at = to_db_time(datetime.datetime.now())
     try:
         if USE_PG:
             pool = await _pg_conn()
             async with pool.acquire() as conn:
-                await conn.execute("""
+                schedule_id = await conn.fetchval("""
                     INSERT INTO schedules 
-                    (chat_id, text, media_url, media_type, button_text, button_url, repeat_seconds, time_period, start_date, end_date, status, remove_last, pin, last_message_id)
-                    VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14)
+                    (chat_id, text, media_url, media_type, button_text, button_url, repeat_seconds, time_period, start_date, end_date, status, remove_last, pin, last_message_id, next_fire_at, media_group)
+                    VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14,$15,$16)
+                    RETURNING id
                 """, chat_id, text, media_url, media_type, button_text, button_url,
                      repeat_seconds, time_period, start_date, end_date,
-                     status, remove_last, pin, last_message_id)
+                     status, remove_last, pin, last_message_id, next_fire_at, media_group)
         else:
             async with _sqlite_conn() as db:
-                await db.execute("""
+                cursor = await db.execute("""
                     INSERT INTO schedules 
-                    (chat_id, text, media_url, media_type, button_text, button_url, repeat_seconds, time_period, start_date, end_date, status, remove_last, pin, last_message_id)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    (chat_id, text, media_url, media_type, button_text, button_url, repeat_seconds, time_period, start_date, end_date, status, remove_last, pin, last_message_id, next_fire_at, media_group)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, (
                     chat_id, text, media_url, media_type, button_text, button_url,
                     repeat_seconds, time_period, start_date, end_date,
-                    status, remove_last, pin, last_message_id
+                    status, remove_last, pin, last_message_id, next_fire_at, media_group
                 ))
+                schedule_id = cursor.lastrowid
+                await cursor.close()
                 await db.commit()
+        _cache_schedule_invalidate_chat(chat_id)
+        _notify_schedule_change(schedule_id)
+        await _publish_change("schedule", schedule_id, chat_id)
+        return schedule_id
     except Exception as e:
         print(f"[add_schedule] ERROR: {e}", flush=True)
+        return None
 
 async def create_schedule(chat_id: int, sch: dict):
     """
     Wrapper to add a schedule from a dict. The dict sch can contain keys:
     text, media_url, media_type, button_text, button_url,
     repeat_seconds, time_period, start_date, end_date,
-    status, remove_last, pin, last_message_id.
+    status, remove_last, pin, last_message_id, media_group.
     """
     return await add_schedule(
         chat_id,
@@ -121,10 +519,19 @@ async def create_schedule(chat_id: int, sch: dict):
         sch.get('status', 1),
         sch.get('remove_last', 0),
         sch.get('pin', 0),
-        sch.get('last_message_id')
+        sch.get('last_message_id'),
+        sch.get('media_group', '')
     )
 
+# update_schedule 会整体覆盖的列及其默认值
+SCHEDULE_UPDATE_DEFAULTS = {
+    "text": "", "media_url": "", "media_type": "", "button_text": "", "button_url": "",
+    "repeat_seconds": 0, "time_period": "", "start_date": "", "end_date": "",
+    "status": 1, "remove_last": 0, "pin": 0, "last_message_id": None, "media_group": "",
+}
+
 async def update_schedule(schedule_id, sch: dict):
+    next_fire_at = to_db_time(datetime.datetime.now())
     try:
         if USE_PG:
             pool = await _pg_conn()
@@ -133,22 +540,24 @@ async def update_schedule(schedule_id, sch: dict):
                     UPDATE schedules SET 
                     text=$1, media_url=$2, media_type=$3, button_text=$4, button_url=$5, 
                     repeat_seconds=$6, time_period=$7, start_date=$8, end_date=$9, 
-                    status=$10, remove_last=$11, pin=$12, last_message_id=$13
-                    WHERE id=$14
+                    status=$10, remove_last=$11, pin=$12, last_message_id=$13,
+                    next_fire_at=$14, media_group=$16
+                    WHERE id=$15
                 """,
                 sch.get('text', ''), sch.get('media_url', ''), sch.get('media_type', ''),
                 sch.get('button_text', ''), sch.get('button_url', ''),
                 sch.get('repeat_seconds', 0), sch.get('time_period', ''),
                 sch.get('start_date', ''), sch.get('end_date', ''),
                 sch.get('status', 1), sch.get('remove_last', 0), sch.get('pin', 0),
-                sch.get('last_message_id'), schedule_id)
+                sch.get('last_message_id'), next_fire_at, schedule_id, sch.get('media_group', ''))
         else:
             async with _sqlite_conn() as db:
                 await db.execute("""
                     UPDATE schedules SET 
                         text=?, media_url=?, media_type=?, button_text=?, button_url=?, 
                         repeat_seconds=?, time_period=?, start_date=?, end_date=?, 
-                        status=?, remove_last=?, pin=?, last_message_id=?
+                        status=?, remove_last=?, pin=?, last_message_id=?,
+                        next_fire_at=?, media_group=?
                     WHERE id=?
                 """, (
                     sch.get('text', ''), sch.get('media_url', ''), sch.get('media_type', ''),
@@ -156,15 +565,24 @@ async def update_schedule(schedule_id, sch: dict):
                     sch.get('repeat_seconds', 0), sch.get('time_period', ''),
                     sch.get('start_date', ''), sch.get('end_date', ''),
                     sch.get('status', 1), sch.get('remove_last', 0), sch.get('pin', 0),
-                    sch.get('last_message_id'), schedule_id
+                    sch.get('last_message_id'), next_fire_at, sch.get('media_group', ''), schedule_id
                 ))
                 await db.commit()
+        _cache_schedule_update(schedule_id, {
+            **{k: sch.get(k, v) for k, v in SCHEDULE_UPDATE_DEFAULTS.items()},
+            "next_fire_at": next_fire_at,
+        })
+        _notify_schedule_change(schedule_id)
+        await _publish_change("schedule", schedule_id)
     except Exception as e:
         print(f"[update_schedule] ERROR: {e}", flush=True)
 
 async def update_schedule_multi(schedule_id, **kwargs):
     if not kwargs:
         return
+    if not set(kwargs) <= SCHEDULE_BOOKKEEPING_FIELDS:
+        # 配置被修改，让调度器立即重新计算推送时间
+        kwargs.setdefault("next_fire_at", to_db_time(datetime.datetime.now()))
     keys = list(kwargs.keys())
     vals = list(kwargs.values())
     try:
@@ -183,6 +601,9 @@ async def update_schedule_multi(schedule_id, **kwargs):
             async with _sqlite_conn() as db:
                 await db.execute(sql, vals)
                 await db.commit()
+        _cache_schedule_update(schedule_id, kwargs)
+        _notify_schedule_change(schedule_id, kwargs)
+        await _publish_change("schedule", schedule_id, fields=kwargs)
     except Exception as e:
         print(f"[update_schedule_multi] ERROR: {e}", flush=True)
 
@@ -202,9 +623,104 @@ async def update_schedule_last_message_id(schedule_id, message_id):
                     (message_id, schedule_id)
                 )
                 await db.commit()
+        _cache_schedule_update(schedule_id, {"last_message_id": message_id})
+        _notify_schedule_change(schedule_id, {"last_message_id": message_id})
+        await _publish_change("schedule", schedule_id, fields=["last_message_id"])
     except Exception as e:
         print(f"[update_schedule_last_message_id] ERROR: {e}", flush=True)
 
+async def update_schedule_media_type(schedule_id, media_url, media_type):
+    """
+    回写推送时探测出的 media_type。只在 media_type 仍为空且 media_url 未被修改时写入，
+    不影响推送时间。
+    """
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                result = await conn.execute("""
+                    UPDATE schedules SET media_type=$1
+                    WHERE id=$2 AND media_url=$3 AND COALESCE(media_type, '')=''
+                """, media_type, schedule_id, media_url)
+            updated = result.endswith(" 1")
+        else:
+            async with _sqlite_conn() as db:
+                cursor = await db.execute("""
+                    UPDATE schedules SET media_type=?
+                    WHERE id=? AND media_url=? AND COALESCE(media_type, '')=''
+                """, (media_type, schedule_id, media_url))
+                updated = cursor.rowcount == 1
+                await db.commit()
+        if updated:
+            _cache_schedule_update(schedule_id, {"media_type": media_type})
+            await _publish_change("schedule", schedule_id, fields=["media_type"])
+    except Exception as e:
+        print(f"[update_schedule_media_type] ERROR: {e}", flush=True)
+
+async def update_schedules_sent(updates, outbox_items=None):
+    """
+    批量回写推送结果，一个事务一次 executemany；
+    outbox_items 非空时在同一事务里写入发件箱，回写与入队要么都成功要么都失败。
+    updates 中每项为 dict：id、claimed_fire_at（认领时写入的租约值）、next_fire_at，
+    可选 last_message_id、last_message_ids、last_sent_time（为 None 时保留原值）。
+    只有 next_fire_at 仍等于租约值时才覆盖它，期间被管理员修改过的定时消息
+    保持“立即重新计算”的标记。
+    """
+    if not updates:
+        return
+    params = [
+        (u["id"], u.get("last_message_id"), u.get("last_sent_time"),
+         u.get("next_fire_at"), u.get("claimed_fire_at"), u.get("last_message_ids"))
+        for u in updates
+    ]
+    outbox_params = _outbox_params(outbox_items or [])
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.executemany("""
+                        UPDATE schedules SET
+                            last_message_id=COALESCE($2, last_message_id),
+                            last_sent_time=COALESCE($3, last_sent_time),
+                            last_message_ids=COALESCE($6, last_message_ids),
+                            next_fire_at=CASE WHEN next_fire_at IS NOT DISTINCT FROM $5
+                                              THEN $4 ELSE next_fire_at END
+                        WHERE id=$1
+                    """, params)
+                    if outbox_params:
+                        await conn.executemany(OUTBOX_INSERT_PG, outbox_params)
+        else:
+            async with _sqlite_conn() as db:
+                await db.executemany("""
+                    UPDATE schedules SET
+                        last_message_id=COALESCE(?2, last_message_id),
+                        last_sent_time=COALESCE(?3, last_sent_time),
+                        last_message_ids=COALESCE(?6, last_message_ids),
+                        next_fire_at=CASE WHEN next_fire_at IS ?5
+                                          THEN ?4 ELSE next_fire_at END
+                    WHERE id=?1
+                """, params)
+                if outbox_params:
+                    await db.executemany(OUTBOX_INSERT_SQLITE, outbox_params)
+                await db.commit()
+        _schedule_cache_touch()
+        for u in updates:
+            row = _schedule_by_id.get(u["id"])
+            if row is None:
+                continue
+            for key in ("last_message_id", "last_message_ids", "last_sent_time"):
+                if u.get(key) is not None:
+                    row[key] = u[key]
+            if row.get("next_fire_at") == u.get("claimed_fire_at"):
+                row["next_fire_at"] = u.get("next_fire_at")
+        fields = ["last_message_id", "last_message_ids", "last_sent_time", "next_fire_at"]
+        for u in updates:
+            _notify_schedule_change(u["id"], dict.fromkeys(fields))
+        await _publish_change("schedule", fields=fields, ids=[u["id"] for u in updates])
+    except Exception as e:
+        print(f"[update_schedules_sent] ERROR: {e}", flush=True)
+
 async def delete_schedule(schedule_id):
     try:
         if USE_PG:
@@ -215,12 +731,410 @@ async def delete_schedule(schedule_id):
             async with _sqlite_conn() as db:
                 await db.execute("DELETE FROM schedules WHERE id=?", (schedule_id,))
                 await db.commit()
+        _cache_schedule_drop(schedule_id)
+        _notify_schedule_change(schedule_id)
+        await _publish_change("schedule", schedule_id)
     except Exception as e:
         print(f"[delete_schedule] ERROR: {e}", flush=True)
 
+# ========================
+# 发件箱（所有出站消息先落库，再由 worker 认领发送）
+# ========================
+OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_DONE, OUTBOX_FAILED = 0, 1, 2, 3
+# claim_outbox 串行认领用的 PG advisory lock 键
+OUTBOX_CLAIM_LOCK = 0x6C756E626F
+
+OUTBOX_INSERT_PG = """
+    INSERT INTO outbox (chat_id, kind, payload, status, attempts, available_at, created_at)
+    VALUES ($1, $2, $3, 0, 0, $4, $5)
+"""
+OUTBOX_INSERT_SQLITE = """
+    INSERT INTO outbox (chat_id, kind, payload, status, attempts, available_at, created_at)
+    VALUES (?, ?, ?, 0, 0, ?, ?)
+"""
+
+def _outbox_params(items):
+    now = to_db_time(datetime.datetime.now())
+    return [
+        (
+            item["chat_id"], item["kind"],
+            json.dumps(item.get("payload") or {}, ensure_ascii=False),
+            to_db_time(item["available_at"]) if item.get("available_at") else now,
+            now,
+        )
+        for item in items
+    ]
+
+async def enqueue_outbox(items):
+    """
+    批量写入发件箱。items 中每项为 dict：chat_id、kind、payload（可 JSON 序列化），
+    可选 available_at（最早发送时间）。
+    """
+    params = _outbox_params(items)
+    if not params:
+        return
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.executemany(OUTBOX_INSERT_PG, params)
+        else:
+            async with _sqlite_conn() as db:
+                await db.executemany(OUTBOX_INSERT_SQLITE, params)
+                await db.commit()
+    except Exception as e:
+        print(f"[enqueue_outbox] ERROR: {e}", flush=True)
+        raise
+
+async def claim_outbox(limit, lease_until, instance_id=INSTANCE_ID, chat_limit=OUTBOX_CHAT_BATCH):
+    """
+    认领可发送的发件箱条目（待发送，或发送中但租约已过期），按 id 顺序返回。
+    已有条目在发送中的群暂不认领，保证同一群内按入队顺序发送；
+    每个群一批最多认领 chat_limit 条，单群限速下一批不会发得太久。
+    """
+    now = to_db_time(datetime.datetime.now())
+    lease_until = lease_until if isinstance(lease_until, str) else to_db_time(lease_until)
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    # 认领串行执行：上一次认领提交后才开始本次查询，
+                    # 否则 NOT IN 子查询看不到并发认领中未提交的条目，同一群的后续条目会被另一个 worker 领走
+                    await conn.execute("SELECT pg_advisory_xact_lock($1)", OUTBOX_CLAIM_LOCK)
+                    rows = await conn.fetch("""
+                        UPDATE outbox SET status=1, attempts=attempts+1, claimed_by=$3, available_at=$4
+                        WHERE id IN (
+                            SELECT id FROM (
+                                SELECT id, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS chat_rank
+                                FROM outbox
+                                WHERE status IN (0, 1) AND available_at <= $1
+                                  AND chat_id NOT IN (
+                                      SELECT chat_id FROM outbox WHERE status=1 AND available_at > $1
+                                  )
+                            ) ready
+                            WHERE chat_rank <= $5
+                            ORDER BY id LIMIT $2
+                        )
+                        RETURNING *
+                    """, now, limit, instance_id, lease_until, chat_limit)
+            rows = [dict(row) for row in rows]
+        else:
+            async with _sqlite_conn() as db:
+                db.row_factory = aiosqlite.Row
+                await db.execute("BEGIN IMMEDIATE")
+                cursor = await db.execute("""
+                    SELECT * FROM (
+                        SELECT *, ROW_NUMBER() OVER (PARTITION BY chat_id ORDER BY id) AS chat_rank
+                        FROM outbox
+                        WHERE status IN (0, 1) AND available_at <= ?
+                          AND chat_id NOT IN (
+                              SELECT chat_id FROM outbox WHERE status=1 AND available_at > ?
+                          )
+                    )
+                    WHERE chat_rank <= ?
+                    ORDER BY id LIMIT ?
+                """, (now, now, chat_limit, limit))
+                rows = [dict(row) for row in await cursor.fetchall()]
+                await cursor.close()
+                if rows:
+                    await db.executemany(
+                        "UPDATE outbox SET status=1, attempts=attempts+1, claimed_by=?, available_at=? WHERE id=?",
+                        [(instance_id, lease_until, row["id"]) for row in rows]
+                    )
+                await db.commit()
+            for row in rows:
+                row.pop("chat_rank", None)
+                row.update(status=1, attempts=row["attempts"] + 1, claimed_by=instance_id, available_at=lease_until)
+        for row in rows:
+            row["payload"] = json.loads(row["payload"] or "{}")
+        return sorted(rows, key=lambda row: row["id"])
+    except Exception as e:
+        print(f"[claim_outbox] ERROR: {e}", flush=True)
+        return []
+
+async def renew_outbox(ids, lease_until, instance_id=INSTANCE_ID):
+    """延长本进程仍在发送的条目的租约，一批发得久时不会被其他 worker 当作过期条目重发"""
+    if not ids:
+        return
+    lease_until = lease_until if isinstance(lease_until, str) else to_db_time(lease_until)
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                    UPDATE outbox SET available_at=$2
+                    WHERE id = ANY($1::bigint[]) AND status=1 AND claimed_by=$3
+                """, list(ids), lease_until, instance_id)
+        else:
+            async with _sqlite_conn() as db:
+                await db.executemany(
+                    "UPDATE outbox SET available_at=? WHERE id=? AND status=1 AND claimed_by=?",
+                    [(lease_until, outbox_id, instance_id) for outbox_id in ids]
+                )
+                await db.commit()
+    except Exception as e:
+        print(f"[renew_outbox] ERROR: {e}", flush=True)
+
+async def finish_outbox(results):
+    """
+    批量记录发送结果。results 中每项为 dict：id、status、
+    可选 result_message_id、error、available_at（重试时间）。
+    """
+    if not results:
+        return
+    params = [
+        (r["id"], r["status"], r.get("result_message_id"), r.get("error"),
+         to_db_time(r["available_at"]) if r.get("available_at") else None)
+        for r in results
+    ]
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.executemany("""
+                    UPDATE outbox SET status=$2, result_message_id=$3, error=$4,
+                        available_at=COALESCE($5, available_at)
+                    WHERE id=$1
+                """, params)
+        else:
+            async with _sqlite_conn() as db:
+                await db.executemany("""
+                    UPDATE outbox SET status=?2, result_message_id=?3, error=?4,
+                        available_at=COALESCE(?5, available_at)
+                    WHERE id=?1
+                """, params)
+                await db.commit()
+    except Exception as e:
+        print(f"[finish_outbox] ERROR: {e}", flush=True)
+
+async def purge_outbox(before):
+    """清理 before 之前创建的已完成/已失败条目"""
+    before = before if isinstance(before, str) else to_db_time(before)
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    "DELETE FROM outbox WHERE status IN (2, 3) AND created_at < $1", before
+                )
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute(
+                    "DELETE FROM outbox WHERE status IN (2, 3) AND created_at < ?", (before,)
+                )
+                await db.commit()
+    except Exception as e:
+        print(f"[purge_outbox] ERROR: {e}", flush=True)
+
+# ========================
+# 延时删除
+# ========================
+async def schedule_deletions(items):
+    """登记到期后要删除的消息，items 为 [(chat_id, message_id, due_at)]"""
+    params = [
+        (chat_id, message_id, due_at if isinstance(due_at, str) else to_db_time(due_at))
+        for chat_id, message_id, due_at in items
+    ]
+    if not params:
+        return
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.executemany(
+                    "INSERT INTO pending_deletions (chat_id, message_id, due_at) VALUES ($1, $2, $3)",
+                    params
+                )
+        else:
+            async with _sqlite_conn() as db:
+                await db.executemany(
+                    "INSERT INTO pending_deletions (chat_id, message_id, due_at) VALUES (?, ?, ?)",
+                    params
+                )
+                await db.commit()
+    except Exception as e:
+        print(f"[schedule_deletions] ERROR: {e}", flush=True)
+
+async def take_due_deletions(now, limit=100):
+    """
+    取出（并从表中移除）最多 limit 条到期的待删除消息，返回 [(chat_id, message_id)]。
+    取出即移除，多个进程同时取也不会重复删除。
+    """
+    now = now if isinstance(now, str) else to_db_time(now)
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    DELETE FROM pending_deletions WHERE id IN (
+                        SELECT id FROM pending_deletions WHERE due_at <= $1
+                        ORDER BY due_at LIMIT $2
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING chat_id, message_id
+                """, now, limit)
+            return [(row["chat_id"], row["message_id"]) for row in rows]
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("BEGIN IMMEDIATE")
+                cursor = await db.execute(
+                    "SELECT id, chat_id, message_id FROM pending_deletions WHERE due_at <= ? ORDER BY due_at LIMIT ?",
+                    (now, limit)
+                )
+                rows = await cursor.fetchall()
+                await cursor.close()
+                if rows:
+                    await db.executemany(
+                        "DELETE FROM pending_deletions WHERE id=?", [(row[0],) for row in rows]
+                    )
+                await db.commit()
+            return [(row[1], row[2]) for row in rows]
+    except Exception as e:
+        print(f"[take_due_deletions] ERROR: {e}", flush=True)
+        return []
+
+# ========================
+# 多实例分片（租约表）
+# ========================
+async def heartbeat_instance(instance_id, ttl):
+    """
+    续约本实例并返回当前存活（ttl 秒内有心跳）的实例 ID 列表。
+    时间取数据库时钟，避免各实例之间的时钟偏差。
+    """
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO bot_instances (instance_id, heartbeat_at)
+                    VALUES ($1, extract(epoch from now()))
+                    ON CONFLICT (instance_id) DO UPDATE SET heartbeat_at=EXCLUDED.heartbeat_at
+                """, instance_id)
+                await conn.execute(
+                    "DELETE FROM bot_instances WHERE heartbeat_at < extract(epoch from now()) - $1",
+                    ttl * 10
+                )
+                rows = await conn.fetch(
+                    "SELECT instance_id FROM bot_instances WHERE heartbeat_at >= extract(epoch from now()) - $1",
+                    ttl
+                )
+            return sorted(row["instance_id"] for row in rows)
+        else:
+            now_sql = "CAST(strftime('%s','now') AS REAL)"
+            async with _sqlite_conn() as db:
+                await db.execute(f"""
+                    INSERT OR REPLACE INTO bot_instances (instance_id, heartbeat_at)
+                    VALUES (?, {now_sql})
+                """, (instance_id,))
+                await db.execute(
+                    f"DELETE FROM bot_instances WHERE heartbeat_at < {now_sql} - ?", (ttl * 10,)
+                )
+                cursor = await db.execute(
+                    f"SELECT instance_id FROM bot_instances WHERE heartbeat_at >= {now_sql} - ?", (ttl,)
+                )
+                rows = await cursor.fetchall()
+                await cursor.close()
+                await db.commit()
+            return sorted(row[0] for row in rows)
+    except Exception as e:
+        print(f"[heartbeat_instance] ERROR: {e}", flush=True)
+        return None
+
+async def remove_instance(instance_id):
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("DELETE FROM bot_instances WHERE instance_id=$1", instance_id)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("DELETE FROM bot_instances WHERE instance_id=?", (instance_id,))
+                await db.commit()
+    except Exception as e:
+        print(f"[remove_instance] ERROR: {e}", flush=True)
+
+# ========================
+# 媒体 file_id 缓存
+# ========================
+# 同一个外链/本地文件首次上传后记下 Telegram 返回的 file_id，之后直接复用，不再重复上传。
+# file_id 对同一个 bot 长期有效，缓存只增不减（失效时由发送方删除）。
+_media_file_ids = {}   # media_key -> {"file_id", "media_type"}
+
+async def fetch_media_file_id(media_key):
+    cached = _media_file_ids.get(media_key)
+    if cached is not None:
+        return cached
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    "SELECT file_id, media_type FROM media_file_ids WHERE media_key=$1", media_key
+                )
+        else:
+            async with _sqlite_conn() as db:
+                cursor = await db.execute(
+                    "SELECT file_id, media_type FROM media_file_ids WHERE media_key=?", (media_key,)
+                )
+                row = await cursor.fetchone()
+                await cursor.close()
+    except Exception as e:
+        print(f"[fetch_media_file_id] ERROR: {e}", flush=True)
+        return None
+    if row is None:
+        return None
+    cached = {"file_id": row[0], "media_type": row[1]}
+    _media_file_ids[media_key] = cached
+    return cached
+
+async def save_media_file_id(media_key, file_id, media_type):
+    _media_file_ids[media_key] = {"file_id": file_id, "media_type": media_type}
+    now = to_db_time(datetime.datetime.now())
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                    INSERT INTO media_file_ids (media_key, file_id, media_type, updated_at)
+                    VALUES ($1, $2, $3, $4)
+                    ON CONFLICT (media_key) DO UPDATE SET
+                        file_id=EXCLUDED.file_id, media_type=EXCLUDED.media_type, updated_at=EXCLUDED.updated_at
+                """, media_key, file_id, media_type, now)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("""
+                    INSERT OR REPLACE INTO media_file_ids (media_key, file_id, media_type, updated_at)
+                    VALUES (?, ?, ?, ?)
+                """, (media_key, file_id, media_type, now))
+                await db.commit()
+    except Exception as e:
+        print(f"[save_media_file_id] ERROR: {e}", flush=True)
+
+async def forget_media_file_id(media_key):
+    _media_file_ids.pop(media_key, None)
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("DELETE FROM media_file_ids WHERE media_key=$1", media_key)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("DELETE FROM media_file_ids WHERE media_key=?", (media_key,))
+                await db.commit()
+    except Exception as e:
+        print(f"[forget_media_file_id] ERROR: {e}", flush=True)
+
 # ========================
 # 关键词回复相关
 # ========================
+# keywords.fuzzy 为匹配方式：0 精准、1 包含、2 正则、3 近似（见 modules/keyword_matcher.py）
+# keywords 表后来新增、需要给旧表补上的列
+KEYWORD_MIGRATION_COLUMNS = {
+    "cooldown": "INTEGER DEFAULT 0",   # 同一关键词两次回复的最短间隔（秒）
+    "max_distance": "INTEGER DEFAULT 1",   # 近似匹配允许的最大编辑距离
+}
+
 async def init_keywords_table():
     try:
         if USE_PG:
@@ -234,9 +1148,13 @@ async def init_keywords_table():
                     fuzzy        INTEGER   DEFAULT 0,
                     enabled      INTEGER   DEFAULT 1,
                     delay        INTEGER   DEFAULT 0,
+                    cooldown     INTEGER   DEFAULT 0,
+                    max_distance INTEGER   DEFAULT 1,
                     PRIMARY KEY (chat_id, keyword)
                 )
                 """)
+                for column, ddl in KEYWORD_MIGRATION_COLUMNS.items():
+                    await conn.execute(f"ALTER TABLE keywords ADD COLUMN IF NOT EXISTS {column} {ddl}")
         else:
             async with _sqlite_conn() as db:
                 await db.execute("""
@@ -247,14 +1165,51 @@ async def init_keywords_table():
                     fuzzy        INTEGER   DEFAULT 0,
                     enabled      INTEGER   DEFAULT 1,
                     delay        INTEGER   DEFAULT 0,
+                    cooldown     INTEGER   DEFAULT 0,
+                    max_distance INTEGER   DEFAULT 1,
                     PRIMARY KEY (chat_id, keyword)
                 )
                 """)
+                await _sqlite_add_columns(db, "keywords", KEYWORD_MIGRATION_COLUMNS)
                 await db.commit()
     except Exception as e:
         print(f"[init_keywords_table] ERROR: {e}", flush=True)
 
+def _invalidate_keyword_index(chat_id=None):
+    global _keyword_index_gen
+    _keyword_index_gen += 1
+    if chat_id is None:
+        _keyword_index.clear()
+    else:
+        _keyword_index.pop(chat_id, None)
+
+def keyword_index_stats():
+    return {**KEYWORD_INDEX_STATS, "chats": len(_keyword_index)}
+
+async def fetch_enabled_keywords(chat_id: int):
+    """
+    自动回复用：该群启用的关键词（按 keyword 排序），稳态下直接从内存索引返回。
+    返回的列表在索引重建前保持同一个对象，调用方不要修改。
+    """
+    rows = _keyword_index.get(chat_id)
+    if rows is not None:
+        KEYWORD_INDEX_STATS["hits"] += 1
+        return rows
+    KEYWORD_INDEX_STATS["misses"] += 1
+    gen = _keyword_index_gen
+    rows = await _fetch_keywords_db(chat_id)
+    if rows is None:
+        return []
+    rows = [row for row in rows if row.get("enabled", 1)]
+    if gen == _keyword_index_gen:
+        _keyword_index[chat_id] = rows
+    return rows
+
 async def fetch_keywords(chat_id: int):
+    return await _fetch_keywords_db(chat_id) or []
+
+async def _fetch_keywords_db(chat_id: int):
+    """查询失败返回 None（不写入索引）"""
     try:
         if USE_PG:
             pool = await _pg_conn()
@@ -274,10 +1229,11 @@ async def fetch_keywords(chat_id: int):
                     return [dict(row) for row in await cursor.fetchall()]
     except Exception as e:
         print(f"[fetch_keywords] ERROR: {e}", flush=True)
-        return []
+        return None
 
 async def add_keyword(chat_id: int, keyword: str, reply: str,
-                      fuzzy: int = 0, enabled: int = 1, delay: int = 0):
+                      fuzzy: int = 0, enabled: int = 1, delay: int = 0,
+                      max_distance: int = 1):
     try:
         if USE_PG:
             pool = await _pg_conn()
@@ -285,27 +1241,36 @@ async def add_keyword(chat_id: int, keyword: str, reply: str,
                 await conn.execute(
                     """
                     INSERT INTO keywords
-                      (chat_id, keyword, reply, fuzzy, enabled, delay)
-                    VALUES ($1, $2, $3, $4, $5, $6)
+                      (chat_id, keyword, reply, fuzzy, enabled, delay, max_distance)
+                    VALUES ($1, $2, $3, $4, $5, $6, $7)
                     ON CONFLICT (chat_id, keyword) DO UPDATE
                       SET reply=EXCLUDED.reply,
                           fuzzy=EXCLUDED.fuzzy,
                           enabled=EXCLUDED.enabled,
-                          delay=EXCLUDED.delay
+                          delay=EXCLUDED.delay,
+                          max_distance=EXCLUDED.max_distance
                     """,
-                    chat_id, keyword, reply, fuzzy, enabled, delay
+                    chat_id, keyword, reply, fuzzy, enabled, delay, max_distance
                 )
         else:
             async with _sqlite_conn() as db:
                 await db.execute(
                     """
-                    INSERT OR REPLACE INTO keywords
-                      (chat_id, keyword, reply, fuzzy, enabled, delay)
-                    VALUES (?, ?, ?, ?, ?, ?)
+                    INSERT INTO keywords
+                      (chat_id, keyword, reply, fuzzy, enabled, delay, max_distance)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (chat_id, keyword) DO UPDATE
+                      SET reply=excluded.reply,
+                          fuzzy=excluded.fuzzy,
+                          enabled=excluded.enabled,
+                          delay=excluded.delay,
+                          max_distance=excluded.max_distance
                     """,
-                    (chat_id, keyword, reply, fuzzy, enabled, delay)
+                    (chat_id, keyword, reply, fuzzy, enabled, delay, max_distance)
                 )
                 await db.commit()
+        _notify_keyword_change(chat_id)
+        await _publish_change("keyword", chat_id=chat_id)
     except Exception as e:
         print(f"[add_keyword] ERROR: {e}", flush=True)
 
@@ -318,16 +1283,93 @@ async def remove_keyword(chat_id: int, keyword: str):
                     "DELETE FROM keywords WHERE chat_id=$1 AND keyword=$2",
                     chat_id, keyword
                 )
+                await conn.execute(
+                    "DELETE FROM keyword_stats WHERE chat_id=$1 AND keyword=$2",
+                    chat_id, keyword
+                )
         else:
             async with _sqlite_conn() as db:
                 await db.execute(
                     "DELETE FROM keywords WHERE chat_id=? AND keyword=?",
                     (chat_id, keyword)
                 )
+                await db.execute(
+                    "DELETE FROM keyword_stats WHERE chat_id=? AND keyword=?",
+                    (chat_id, keyword)
+                )
                 await db.commit()
+        _notify_keyword_change(chat_id)
+        await _publish_change("keyword", chat_id=chat_id)
     except Exception as e:
         print(f"[remove_keyword] ERROR: {e}", flush=True)
 
+async def add_keyword_stats(items):
+    """
+    把内存中累计的命中数累加进 keyword_stats，一次 executemany 写完。
+    items 为 [(chat_id, keyword, hits, suppressed, last_hit)]，last_hit 为空表示本期没有回复。
+    已删除的关键词（包括其他进程删除的）不再写入，不会留下孤立的统计行。
+    返回是否写入成功（失败时调用方保留计数，下次再写）。
+    """
+    params = [
+        (chat_id, keyword, hits, suppressed, last_hit if isinstance(last_hit, str) or last_hit is None else to_db_time(last_hit))
+        for chat_id, keyword, hits, suppressed, last_hit in items
+    ]
+    if not params:
+        return True
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.executemany("""
+                    INSERT INTO keyword_stats (chat_id, keyword, hits, suppressed, last_hit)
+                    SELECT $1::bigint, $2::text, $3::bigint, $4::bigint, $5::text
+                    WHERE EXISTS (SELECT 1 FROM keywords WHERE chat_id=$1 AND keyword=$2)
+                    ON CONFLICT (chat_id, keyword) DO UPDATE SET
+                        hits=keyword_stats.hits + EXCLUDED.hits,
+                        suppressed=keyword_stats.suppressed + EXCLUDED.suppressed,
+                        last_hit=COALESCE(EXCLUDED.last_hit, keyword_stats.last_hit)
+                """, params)
+        else:
+            async with _sqlite_conn() as db:
+                await db.executemany("""
+                    INSERT INTO keyword_stats (chat_id, keyword, hits, suppressed, last_hit)
+                    SELECT ?1, ?2, ?3, ?4, ?5
+                    WHERE EXISTS (SELECT 1 FROM keywords WHERE chat_id=?1 AND keyword=?2)
+                    ON CONFLICT (chat_id, keyword) DO UPDATE SET
+                        hits=keyword_stats.hits + excluded.hits,
+                        suppressed=keyword_stats.suppressed + excluded.suppressed,
+                        last_hit=COALESCE(excluded.last_hit, keyword_stats.last_hit)
+                """, params)
+                await db.commit()
+        return True
+    except Exception as e:
+        print(f"[add_keyword_stats] ERROR: {e}", flush=True)
+        return False
+
+async def fetch_keyword_stats(chat_id: int):
+    """返回 {keyword: {hits, suppressed, last_hit}}"""
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                rows = await conn.fetch(
+                    "SELECT keyword, hits, suppressed, last_hit FROM keyword_stats WHERE chat_id=$1",
+                    chat_id
+                )
+                rows = [dict(r) for r in rows]
+        else:
+            async with _sqlite_conn() as db:
+                db.row_factory = aiosqlite.Row
+                async with db.execute(
+                    "SELECT keyword, hits, suppressed, last_hit FROM keyword_stats WHERE chat_id=?",
+                    (chat_id,)
+                ) as cur:
+                    rows = [dict(r) for r in await cur.fetchall()]
+        return {r.pop("keyword"): r for r in rows}
+    except Exception as e:
+        print(f"[fetch_keyword_stats] ERROR: {e}", flush=True)
+        return {}
+
 async def update_keyword_enable(chat_id: int, keyword: str, enabled: int):
     try:
         if USE_PG:
@@ -344,6 +1386,8 @@ async def update_keyword_enable(chat_id: int, keyword: str, enabled: int):
                     (enabled, chat_id, keyword)
                 )
                 await db.commit()
+        _notify_keyword_change(chat_id)
+        await _publish_change("keyword", chat_id=chat_id)
     except Exception as e:
         print(f"[update_keyword_enable] ERROR: {e}", flush=True)
 
@@ -363,9 +1407,32 @@ async def update_keyword_delay(chat_id: int, keyword: str, delay: int):
                     (delay, chat_id, keyword)
                 )
                 await db.commit()
+        _notify_keyword_change(chat_id)
+        await _publish_change("keyword", chat_id=chat_id)
     except Exception as e:
         print(f"[update_keyword_delay] ERROR: {e}", flush=True)
 
+async def update_keyword_cooldown(chat_id: int, keyword: str, cooldown: int):
+    try:
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    "UPDATE keywords SET cooldown=$1 WHERE chat_id=$2 AND keyword=$3",
+                    cooldown, chat_id, keyword
+                )
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute(
+                    "UPDATE keywords SET cooldown=? WHERE chat_id=? AND keyword=?",
+                    (cooldown, chat_id, keyword)
+                )
+                await db.commit()
+        _notify_keyword_change(chat_id)
+        await _publish_change("keyword", chat_id=chat_id)
+    except Exception as e:
+        print(f"[update_keyword_cooldown] ERROR: {e}", flush=True)
+
 async def update_keyword_reply(chat_id: int, keyword: str, reply: str):
     try:
         if USE_PG:
@@ -382,12 +1449,26 @@ async def update_keyword_reply(chat_id: int, keyword: str, reply: str):
                     (reply, chat_id, keyword)
                 )
                 await db.commit()
+        _notify_keyword_change(chat_id)
+        await _publish_change("keyword", chat_id=chat_id)
     except Exception as e:
         print(f"[update_keyword_reply] ERROR: {e}", flush=True)
 
 # ========================
 # 数据库初始化
 # ========================
+# 后来新增、需要给旧表补上的列
+SCHEDULE_MIGRATION_COLUMNS = ("last_sent_time", "next_fire_at", "media_group", "last_message_ids")
+
+async def _sqlite_add_columns(db, table, columns: dict):
+    """SQLite 没有 ADD COLUMN IF NOT EXISTS，先查已有列再补"""
+    cursor = await db.execute(f"PRAGMA table_info({table})")
+    existing = {row[1] for row in await cursor.fetchall()}
+    await cursor.close()
+    for column, ddl in columns.items():
+        if column not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
 async def init_db():
     try:
         # schedules 表
@@ -410,9 +1491,25 @@ async def init_db():
                     status          INTEGER  DEFAULT 1,
                     remove_last     INTEGER  DEFAULT 0,
                     pin             INTEGER  DEFAULT 0,
-                    last_message_id BIGINT
+                    last_message_id BIGINT,
+                    last_sent_time  TEXT,
+                    next_fire_at    TEXT,
+                    media_group     TEXT,
+                    last_message_ids TEXT
                 )
                 """)
+                # 旧表补列
+                for column in SCHEDULE_MIGRATION_COLUMNS:
+                    await conn.execute(
+                        f"ALTER TABLE schedules ADD COLUMN IF NOT EXISTS {column} TEXT"
+                    )
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_schedules_due ON schedules (status, next_fire_at)"
+                )
+                await conn.execute(
+                    "UPDATE schedules SET next_fire_at=$1 WHERE status=1 AND next_fire_at IS NULL",
+                    to_db_time(datetime.datetime.now())
+                )
         else:
             async with _sqlite_conn() as db:
                 await db.execute("""
@@ -431,13 +1528,180 @@ async def init_db():
                     status          INTEGER  DEFAULT 1,
                     remove_last     INTEGER  DEFAULT 0,
                     pin             INTEGER  DEFAULT 0,
-                    last_message_id INTEGER
+                    last_message_id INTEGER,
+                    last_sent_time  TEXT,
+                    next_fire_at    TEXT,
+                    media_group     TEXT,
+                    last_message_ids TEXT
                 )
                 """)
+                # 旧表补列
+                await _sqlite_add_columns(db, "schedules", {
+                    column: "TEXT" for column in SCHEDULE_MIGRATION_COLUMNS
+                })
+                await db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_schedules_due ON schedules (status, next_fire_at)"
+                )
+                await db.execute(
+                    "UPDATE schedules SET next_fire_at=? WHERE status=1 AND next_fire_at IS NULL",
+                    (to_db_time(datetime.datetime.now()),)
+                )
                 await db.commit()
 
         # keywords 表
         await init_keywords_table()
 
+        # 发件箱
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id                 BIGSERIAL PRIMARY KEY,
+                    chat_id            BIGINT   NOT NULL,
+                    kind               TEXT     NOT NULL,
+                    payload            TEXT     NOT NULL,
+                    status             INTEGER  DEFAULT 0,
+                    attempts           INTEGER  DEFAULT 0,
+                    available_at       TEXT     NOT NULL,
+                    claimed_by         TEXT,
+                    result_message_id  BIGINT,
+                    error              TEXT,
+                    created_at         TEXT
+                )
+                """)
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox (status, available_at)"
+                )
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id            INTEGER  NOT NULL,
+                    kind               TEXT     NOT NULL,
+                    payload            TEXT     NOT NULL,
+                    status             INTEGER  DEFAULT 0,
+                    attempts           INTEGER  DEFAULT 0,
+                    available_at       TEXT     NOT NULL,
+                    claimed_by         TEXT,
+                    result_message_id  INTEGER,
+                    error              TEXT,
+                    created_at         TEXT
+                )
+                """)
+                await db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_outbox_ready ON outbox (status, available_at)"
+                )
+                await db.commit()
+
+        # 延时删除表
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending_deletions (
+                    id          BIGSERIAL PRIMARY KEY,
+                    chat_id     BIGINT NOT NULL,
+                    message_id  BIGINT NOT NULL,
+                    due_at      TEXT   NOT NULL
+                )
+                """)
+                await conn.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_pending_deletions_due ON pending_deletions (due_at)"
+                )
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("""
+                CREATE TABLE IF NOT EXISTS pending_deletions (
+                    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id     INTEGER NOT NULL,
+                    message_id  INTEGER NOT NULL,
+                    due_at      TEXT    NOT NULL
+                )
+                """)
+                await db.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_pending_deletions_due ON pending_deletions (due_at)"
+                )
+                await db.commit()
+
+        # 实例租约表
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS bot_instances (
+                    instance_id   TEXT PRIMARY KEY,
+                    heartbeat_at  DOUBLE PRECISION NOT NULL
+                )
+                """)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("""
+                CREATE TABLE IF NOT EXISTS bot_instances (
+                    instance_id   TEXT PRIMARY KEY,
+                    heartbeat_at  REAL NOT NULL
+                )
+                """)
+                await db.commit()
+
+        # 媒体 file_id 缓存（两种数据库建表语句相同）
+        create_media = """
+        CREATE TABLE IF NOT EXISTS media_file_ids (
+            media_key   TEXT PRIMARY KEY,
+            file_id     TEXT NOT NULL,
+            media_type  TEXT NOT NULL,
+            updated_at  TEXT
+        )
+        """
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute(create_media)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute(create_media)
+                await db.commit()
+
+        # 关键词命中统计
+        if USE_PG:
+            pool = await _pg_conn()
+            async with pool.acquire() as conn:
+                await conn.execute("""
+                CREATE TABLE IF NOT EXISTS keyword_stats (
+                    chat_id     BIGINT   NOT NULL,
+                    keyword     TEXT     NOT NULL,
+                    hits        BIGINT   DEFAULT 0,
+                    suppressed  BIGINT   DEFAULT 0,
+                    last_hit    TEXT,
+                    PRIMARY KEY (chat_id, keyword)
+                )
+                """)
+        else:
+            async with _sqlite_conn() as db:
+                await db.execute("""
+                CREATE TABLE IF NOT EXISTS keyword_stats (
+                    chat_id     INTEGER  NOT NULL,
+                    keyword     TEXT     NOT NULL,
+                    hits        INTEGER  DEFAULT 0,
+                    suppressed  INTEGER  DEFAULT 0,
+                    last_hit    TEXT,
+                    PRIMARY KEY (chat_id, keyword)
+                )
+                """)
+                await db.commit()
+
+        # SQLite 跨进程缓存失效事件表（PG 使用 NOTIFY，不需要）
+        if not USE_PG:
+            async with _sqlite_conn() as db:
+                await db.execute("""
+                CREATE TABLE IF NOT EXISTS cache_events (
+                    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+                    src      TEXT,
+                    payload  TEXT
+                )
+                """)
+                await db.commit()
+
     except Exception as e:
         print(f"[init_db] ERROR: {e}", flush=True)
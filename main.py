@@ -6,8 +6,11 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler,
     CallbackQueryHandler, filters, ConversationHandler
 )
-from config import BOT_TOKEN, WEBHOOK_URL, GROUPS
-from db import init_db, fetch_schedules
+from config import (
+    BOT_TOKEN, WEBHOOK_URL, GROUPS,
+    TG_GLOBAL_RATE, TG_GROUP_PER_MINUTE, TG_MAX_RETRIES, MEDIA_CACHE_DIR
+)
+from db import init_db, fetch_schedules, start_cache_listener, stop_cache_listener
 from modules.scheduler import (
     show_schedule_list, entry_add_schedule, confirm_callback,
     add_text, add_media, add_button, add_repeat, add_period,
@@ -28,6 +31,11 @@ from modules.scheduler import (
     EDIT_REPEAT, EDIT_PERIOD, EDIT_START_DATE, EDIT_END_DATE
 )
 from scheduled_sender import scheduled_sender
+from modules.sharding import ShardCoordinator
+from modules.outbox import OutboxWorkerPool
+from modules.deletions import DeletionDrainer
+from modules.keyword_stats import KEYWORD_STATS
+from modules import media_cache
 from modules.keyboards import (
     schedule_list_menu, group_feature_menu, group_select_menu
 )
@@ -36,8 +44,10 @@ from modules.keywords_reply import (
     keywords_setting_entry, kw_add_start, kw_add_receive,
     kw_remove, kw_remove_confirm, kw_enable, kw_enable_confirm,
     kw_disable, kw_disable_confirm, kw_delay, kw_delayset_confirm,
+    kw_cooldown, kw_cooldownset_confirm,
     keyword_autoreply, kw_edit, kw_edit_entry, kw_edit_save
 )
+from modules.rate_limiter import TokenBucketRateLimiter
 from telegram.error import BadRequest
 
 logging.basicConfig(level=logging.INFO)
@@ -139,7 +149,13 @@ async def main_menu_callback(update, context):
     )
 
 def main():
-    application = ApplicationBuilder().token(BOT_TOKEN).build()
+    # 所有出站请求（定时推送、广播、关键词回复）共用一个限速器
+    rate_limiter = TokenBucketRateLimiter(
+        global_rate=TG_GLOBAL_RATE,
+        group_per_minute=TG_GROUP_PER_MINUTE,
+        max_retries=TG_MAX_RETRIES,
+    )
+    application = ApplicationBuilder().token(BOT_TOKEN).rate_limiter(rate_limiter).build()
 
     # /start 和 /schedule
     application.add_handler(CommandHandler("start", start))
@@ -270,6 +286,8 @@ def main():
     application.add_handler(CallbackQueryHandler(kw_disable_confirm, pattern=r"^kw_disable_"))
     application.add_handler(CallbackQueryHandler(kw_delay, pattern=r"^kw_delay_\d+$"))
     application.add_handler(CallbackQueryHandler(kw_delayset_confirm, pattern=r"^kw_delayset_"))
+    application.add_handler(CallbackQueryHandler(kw_cooldown, pattern=r"^kw_cd_\d+$"))
+    application.add_handler(CallbackQueryHandler(kw_cooldownset_confirm, pattern=r"^kw_cdset_"))
 
     # 群内自动回复（仅限群组）
     application.add_handler(
@@ -278,11 +296,33 @@ def main():
 
     async def on_startup(app):
         await init_db()
+        start_cache_listener()
         app.bot_data["GROUPS"] = GROUPS
         logging.info("数据库初始化完成")
+        # 所有出站消息经发件箱由 worker 池发送
+        pool = OutboxWorkerPool(app.bot)
+        pool.start()
+        app.bot_data["outbox_pool"] = pool
+        # 延时删除（关键词回复等）由后台任务按到期时间批量执行
+        drainer = DeletionDrainer(app.bot)
+        drainer.start()
+        app.bot_data["deletion_drainer"] = drainer
+        # 关键词命中统计定期批量写库
+        KEYWORD_STATS.start()
+        # 多实例部署时按存活实例分配群组，避免重复推送
+        coordinator = ShardCoordinator(list(GROUPS.keys()))
+        await coordinator.start()
+        app.bot_data["shard_coordinator"] = coordinator
         app.bot_data["bg_task"] = asyncio.create_task(
-            scheduled_sender(application, list(GROUPS.keys()))
+            scheduled_sender(application, list(GROUPS.keys()), coordinator)
         )
+        # 可选：提前把即将推送的外链媒体下载到本地
+        if MEDIA_CACHE_DIR:
+            cache = media_cache.MediaCache()
+            media_cache.install(cache)
+            prefetcher = media_cache.MediaPrefetcher(cache, list(GROUPS.keys()), coordinator)
+            prefetcher.start()
+            app.bot_data["media_prefetcher"] = prefetcher
 
     async def on_shutdown(app):
         task = app.bot_data.get("bg_task")
@@ -292,6 +332,20 @@ def main():
                 await task
             except asyncio.CancelledError:
                 pass
+        prefetcher = app.bot_data.get("media_prefetcher")
+        if prefetcher:
+            await prefetcher.stop()
+        coordinator = app.bot_data.get("shard_coordinator")
+        if coordinator:
+            await coordinator.stop()
+        pool = app.bot_data.get("outbox_pool")
+        if pool:
+            await pool.stop()
+        drainer = app.bot_data.get("deletion_drainer")
+        if drainer:
+            await drainer.stop()
+        await KEYWORD_STATS.stop()
+        await stop_cache_listener()
         logging.info("后台任务已关闭。")
 
     application.post_init = on_startup
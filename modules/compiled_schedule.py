@@ -0,0 +1,203 @@
+import copy
+import datetime
+import json
+import math
+import zlib
+from config import SCHEDULE_PLACEMENT
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from modules.send_media import send_media, send_media_group
+
+def parse_time_period(time_period: str):
+    """解析时间段字符串，返回起止时间（时分）元组"""
+    if not time_period:
+        return None, None
+    try:
+        start_str, end_str = time_period.split("-")
+        start_h, start_m = map(int, start_str.split(":"))
+        end_h, end_m = map(int, end_str.split(":"))
+        return (start_h, start_m), (end_h, end_m)
+    except Exception:
+        return None, None
+
+def parse_json_list(value):
+    """解析 JSON 数组列（media_group、last_message_ids），为空或格式错误时返回空列表"""
+    if not value:
+        return []
+    try:
+        parsed = json.loads(value)
+    except (TypeError, ValueError):
+        return []
+    return parsed if isinstance(parsed, list) else []
+
+def parse_date(value: str):
+    """解析 2025-06-12 或 2025-06-12 09:30 格式的日期，无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M" if " " in value else "%Y-%m-%d")
+    except Exception:
+        return None
+
+# spread 模式的时间网格原点
+_GRID_EPOCH = datetime.datetime(2000, 1, 1)
+
+def slot_offset(schedule_id, repeat_seconds: int) -> int:
+    """定时消息在周期内的固定偏移（秒），由 ID 确定，重启后不变"""
+    return zlib.crc32(str(schedule_id).encode()) % repeat_seconds
+
+def align_to_slot(t: datetime.datetime, offset: int, repeat_seconds: int) -> datetime.datetime:
+    """返回不早于 t 的第一个网格点：_GRID_EPOCH + offset + k * repeat_seconds"""
+    elapsed = (t - _GRID_EPOCH).total_seconds() - offset
+    k = math.ceil(elapsed / repeat_seconds)
+    return _GRID_EPOCH + datetime.timedelta(seconds=offset + k * repeat_seconds)
+
+def parse_db_time(value):
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except Exception:
+            return None
+    return value
+
+class CompiledSchedule:
+    """
+    由一行 schedules 记录预先解析而成的定时消息。
+    时间段转成当天分钟数、起止日期转成 datetime、按钮提前构造好，
+    判断是否可推送只需要几次整数/时间比较。
+    """
+
+    __slots__ = (
+        "id", "chat_id", "status", "repeat_seconds",
+        "period_start", "period_end", "start_date", "end_date",
+        "text", "media_url", "media_type", "media_group", "markup",
+        "remove_last", "pin", "last_message_id", "last_message_ids", "last_sent_time", "slot_offset",
+    )
+
+    def __init__(self, row: dict):
+        self.id = row["id"]
+        self.chat_id = row["chat_id"]
+        self.status = bool(row.get("status"))
+        self.repeat_seconds = int(row.get("repeat_seconds") or 0)
+        start, end = parse_time_period(row.get("time_period") or "")
+        if start and end:
+            self.period_start = start[0] * 60 + start[1]
+            self.period_end = end[0] * 60 + end[1]
+        else:
+            self.period_start = self.period_end = None
+        self.start_date = parse_date(row.get("start_date") or "")
+        self.end_date = parse_date(row.get("end_date") or "")
+        self.text = row.get("text") or ""
+        self.media_url = row.get("media_url") or ""
+        self.media_type = row.get("media_type") or ""
+        self.media_group = parse_json_list(row.get("media_group"))
+        button_text = row.get("button_text") or ""
+        button_url = row.get("button_url") or ""
+        self.markup = None
+        if button_text and button_url:
+            self.markup = InlineKeyboardMarkup([[InlineKeyboardButton(button_text, url=button_url)]])
+        self.remove_last = bool(row.get("remove_last"))
+        self.pin = bool(row.get("pin"))
+        self._load_state(row)
+        self.slot_offset = None
+        if SCHEDULE_PLACEMENT == "spread" and self.repeat_seconds > 0:
+            self.slot_offset = slot_offset(self.id, self.repeat_seconds)
+
+    def _load_state(self, row: dict):
+        """推送方回写的字段：上一次发出的消息与推送时间"""
+        self.last_message_id = row.get("last_message_id")
+        self.last_message_ids = parse_json_list(row.get("last_message_ids"))
+        self.last_sent_time = parse_db_time(row.get("last_sent_time"))
+
+    def with_state(self, row: dict):
+        """复制一份并换上 row 中推送方回写的字段，配置部分沿用已解析的结果，自身不被修改"""
+        sch = copy.copy(self)
+        sch._load_state(row)
+        return sch
+
+    def in_period(self, now: datetime.datetime) -> bool:
+        """判断当前时间是否在时间段内（支持跨天，起止相同视为空时间段）"""
+        if self.period_start is None:
+            return True
+        now_min = now.hour * 60 + now.minute
+        if self.period_start <= self.period_end:
+            return self.period_start <= now_min < self.period_end
+        # 跨天
+        return now_min >= self.period_start or now_min < self.period_end
+
+    def in_date(self, now: datetime.datetime) -> bool:
+        if self.start_date and now < self.start_date:
+            return False
+        if self.end_date and now > self.end_date:
+            return False
+        return True
+
+    def is_active(self, now: datetime.datetime) -> bool:
+        """启用、在有效日期内且在时间段内"""
+        return self.status and self.in_date(now) and self.in_period(now)
+
+    def next_in_period(self, t: datetime.datetime):
+        """返回不早于 t 且落在时间段内的最早时间点；时间段为空集时返回 None"""
+        if self.period_start is None:
+            return t
+        if self.period_start == self.period_end:
+            return None
+        if self.in_period(t):
+            return t
+        candidate = t.replace(hour=0, minute=0, second=0, microsecond=0) + \
+            datetime.timedelta(minutes=self.period_start)
+        if candidate < t:
+            candidate += datetime.timedelta(days=1)
+        return candidate
+
+    def next_fire(self, now: datetime.datetime):
+        """
+        计算下一次推送时间（不早于 now），不再需要推送时返回 None。
+        repeat_seconds 为 0 表示单次消息，推送过一次即结束。
+        """
+        if not self.status:
+            return None
+        if self.last_sent_time:
+            if self.repeat_seconds <= 0:
+                return None
+            candidate = max(now, self.last_sent_time + datetime.timedelta(seconds=self.repeat_seconds))
+        else:
+            candidate = now
+        if self.start_date and candidate < self.start_date:
+            candidate = self.start_date
+        candidate = self.next_in_period(candidate)
+        # 从未推送过的消息立即发出，之后对齐到自己的网格点
+        if candidate is not None and self.slot_offset is not None and self.last_sent_time:
+            candidate = self._align_in_period(candidate)
+        if candidate is None or (self.end_date and candidate > self.end_date):
+            return None
+        return candidate
+
+    def _align_in_period(self, t: datetime.datetime):
+        """对齐到网格点且仍落在时间段内；时间段太窄找不到时退回未对齐的时间"""
+        candidate = t
+        for _ in range(8):
+            aligned = align_to_slot(candidate, self.slot_offset, self.repeat_seconds)
+            if self.in_period(aligned):
+                return aligned
+            candidate = self.next_in_period(aligned)
+        return t
+
+    def previous_message_ids(self):
+        """上一次推送发出的全部消息 ID（相册为多条）"""
+        if self.last_message_ids:
+            return list(self.last_message_ids)
+        return [self.last_message_id] if self.last_message_id else []
+
+    async def send(self, bot):
+        """发送消息本体（文本、媒体或相册），返回发送出的消息列表，失败时为空列表"""
+        if self.media_group:
+            # 相册不能带按钮
+            return await send_media_group(bot, self.chat_id, self.media_group, caption=self.text) or []
+        if self.media_url:
+            msg = await send_media(
+                bot, self.chat_id, self.media_url,
+                caption=self.text, buttons=self.markup, media_type=self.media_type
+            )
+        else:
+            msg = await bot.send_message(chat_id=self.chat_id, text=self.text, reply_markup=self.markup)
+        return [msg] if msg else []
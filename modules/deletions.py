@@ -0,0 +1,60 @@
+import asyncio
+import datetime
+import db
+from config import DELETION_BATCH, DELETION_POLL_INTERVAL
+from modules.outbox import dispatch_by_chat
+from modules.send_media import delete_messages
+
+class DeletionDrainer:
+    """
+    延时删除：到期时间记录在 pending_deletions 表（重启不丢），
+    一个后台循环按到期顺序成批取出，同一群的消息合并成一次批量删除。
+    """
+
+    def __init__(self, bot, batch=DELETION_BATCH, poll_interval=DELETION_POLL_INTERVAL):
+        self.bot = bot
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self._task = None
+        self.stats = {"deleted": 0, "batches": 0}
+
+    async def _delete_chat(self, item):
+        await delete_messages(self.bot, item["chat_id"], item["message_ids"])
+
+    async def run_batch(self):
+        """删除一批到期消息，返回取出的条数"""
+        due = await db.take_due_deletions(datetime.datetime.now(), self.batch)
+        if not due:
+            return 0
+        by_chat = {}
+        for chat_id, message_id in due:
+            by_chat.setdefault(chat_id, []).append(message_id)
+        await dispatch_by_chat(
+            [{"chat_id": chat_id, "message_ids": ids} for chat_id, ids in by_chat.items()],
+            self._delete_chat
+        )
+        self.stats["deleted"] += len(due)
+        self.stats["batches"] += 1
+        return len(due)
+
+    async def _loop(self):
+        while True:
+            try:
+                taken = await self.run_batch()
+            except Exception as e:
+                print(f"[deletions] 删除异常: {e}", flush=True)
+                taken = 0
+            if taken < self.batch:
+                await asyncio.sleep(self.poll_interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
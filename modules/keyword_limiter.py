@@ -0,0 +1,52 @@
+import time
+from config import KEYWORD_CHAT_WINDOW, KEYWORD_CHAT_MAX_REPLIES
+
+class RingWindow:
+    """
+    固定容量的时间戳环形缓冲：window 秒内最多放行 capacity 次。
+    下一个要覆盖的槽位就是最早的一次，判断只需一次比较。
+    """
+
+    __slots__ = ("_times", "_next")
+
+    def __init__(self, capacity: int):
+        self._times = [float("-inf")] * capacity
+        self._next = 0
+
+    def allow(self, now: float, window: float) -> bool:
+        if now - self._times[self._next] < window:
+            return False
+        self._times[self._next] = now
+        self._next = (self._next + 1) % len(self._times)
+        return True
+
+class ReplyLimiter:
+    """
+    关键词自动回复限流：单个关键词的冷却时间（keywords.cooldown 列）
+    加上每个群的滑动窗口上限。不论入站消息多少，出站回复数都有上界。
+    被抑制的命中由调用方计入 KEYWORD_STATS（keyword_stats 模块）。
+    """
+
+    def __init__(self, chat_max=KEYWORD_CHAT_MAX_REPLIES, chat_window=KEYWORD_CHAT_WINDOW):
+        self.chat_max = chat_max
+        self.chat_window = chat_window
+        self._chats = {}                          # chat_id -> RingWindow
+        self._last = {}                           # (chat_id, keyword) -> 上次回复时间
+
+    def allow(self, chat_id, keyword, cooldown=0, now=None) -> bool:
+        """本次命中是否回复"""
+        now = time.monotonic() if now is None else now
+        key = (chat_id, keyword)
+        if cooldown and now - self._last.get(key, float("-inf")) < cooldown:
+            return False
+        if self.chat_max > 0:
+            ring = self._chats.get(chat_id)
+            if ring is None:
+                ring = self._chats[chat_id] = RingWindow(self.chat_max)
+            if not ring.allow(now, self.chat_window):
+                return False
+        if cooldown:
+            self._last[key] = now
+        return True
+
+REPLY_LIMITER = ReplyLimiter()
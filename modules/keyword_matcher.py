@@ -0,0 +1,492 @@
+import bisect
+import re
+try:
+    import re._parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+try:
+    import re2  # 可选：线性时间的正则引擎（pip install google-re2），没有时使用标准库 re
+except ImportError:
+    re2 = None
+from modules.text_normalize import normalize
+
+# keywords.fuzzy 列存匹配方式
+MODE_EXACT = 0      # 精准：整条消息等于关键词
+MODE_CONTAINS = 1   # 包含：消息中出现关键词
+MODE_REGEX = 2      # 正则：re.search 命中
+MODE_APPROX = 3     # 近似：整条消息与关键词的编辑距离不超过 max_distance（容忍错别字）
+
+REGEX_MAX_LENGTH = 200
+# 正则只匹配消息的前这么多个字，限制标准库 re 回溯的最坏耗时
+REGEX_MAX_TEXT = 300
+APPROX_MAX_DISTANCE = 3
+# 近似关键词最长字数：删除变体数随长度按距离次方增长，距离 3 时 60 个字的关键词单条匹配就要几十毫秒
+APPROX_MAX_LENGTH = 20
+# 正则在 REGEX_MAX_TEXT 个起点上估算的回溯拆法总数上限（见 _backtrack_cost），约合几十毫秒
+REGEX_MAX_STEPS = 1_000_000
+
+# 预筛统计：messages 为进入匹配器的消息数，rejected 为预筛判定不可能命中、跳过扫描的消息数
+PREFILTER_STATS = {"messages": 0, "rejected": 0}
+
+def prefilter_stats():
+    messages = PREFILTER_STATS["messages"]
+    return {
+        **PREFILTER_STATS,
+        "hit_rate": PREFILTER_STATS["rejected"] / messages if messages else 0.0,
+    }
+
+def _has_nested_repeat(items, inside_repeat=False):
+    """
+    次数不定的量词里再套次数不定的量词（如 (a+)+、(a*)*、(a{1,30}){1,30}）会导致指数级回溯；
+    外层有上限也一样，拆法数随上限指数增长。外层次数固定的（如 (\\d{1,3}\\.){3}）交给 _backtrack_cost 估算
+    """
+    for op, arg in items:
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None)):
+            low, high, sub = arg
+            if inside_repeat and high > 1 and low != high:
+                return True
+            if _has_nested_repeat(sub, inside_repeat or low != high):
+                return True
+        elif op == sre_parse.SUBPATTERN:
+            if _has_nested_repeat(arg[-1], inside_repeat):
+                return True
+        elif op == sre_parse.BRANCH:
+            if any(_has_nested_repeat(branch, inside_repeat) for branch in arg[1]):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if _has_nested_repeat(arg[1], inside_repeat):
+                return True
+    return False
+
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, "POSSESSIVE_REPEAT", None))
+
+def _nullable(items):
+    """items 能否匹配空串"""
+    for op, arg in items:
+        if op in _REPEATS:
+            if arg[0] > 0 and not _nullable(arg[2]):
+                return False
+        elif op == sre_parse.SUBPATTERN:
+            if not _nullable(arg[-1]):
+                return False
+        elif op == sre_parse.BRANCH:
+            if not any(_nullable(branch) for branch in arg[1]):
+                return False
+        elif op not in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            return False
+    return True
+
+def _first_chars(items):
+    """items 第一个字符可能的取值，返回 [(下限, 上限)] 码点区间；无法确定时返回 None"""
+    if not items:
+        return None
+    op, arg = items[0]
+    if op == sre_parse.LITERAL:
+        return [(arg, arg)]
+    if op == sre_parse.IN:
+        ranges = []
+        for sub_op, sub_arg in arg:
+            if sub_op == sre_parse.LITERAL:
+                ranges.append((sub_arg, sub_arg))
+            elif sub_op == sre_parse.RANGE:
+                ranges.append(sub_arg)
+            else:  # 取反、\d \w 等类别
+                return None
+        return ranges
+    if op == sre_parse.SUBPATTERN:
+        add_flags = arg[1]
+        if add_flags & sre_parse.SRE_FLAG_IGNORECASE or _nullable(arg[-1]):
+            return None
+        return _first_chars(arg[-1])
+    if op == sre_parse.BRANCH:
+        ranges = []
+        for branch in arg[1]:
+            first = _first_chars(branch)
+            if first is None:
+                return None
+            ranges += first
+        return ranges
+    if op in _REPEATS and arg[0] > 0:
+        return _first_chars(arg[2])
+    return None
+
+def _overlaps(alternatives):
+    """各分支的首字符区间是否有交集"""
+    seen = []
+    for ranges in alternatives:
+        for low, high in ranges:
+            if any(low <= h and l <= high for l, h in seen):
+                return True
+        seen += ranges
+    return False
+
+def _has_ambiguous_repeat(items, inside_repeat=False):
+    """
+    可重复多次的量词里出现能匹配空串的内容、或首字符可能相同的分支（如 (a|aa)*、(a|ab)*、(a|a){1,25}），
+    同一段文本有指数多种拆法，不匹配时会逐一回溯
+    """
+    for op, arg in items:
+        if op in _REPEATS:
+            repeating = arg[1] > 1
+            if repeating and _nullable(arg[2]):
+                return True
+            if _has_ambiguous_repeat(arg[2], inside_repeat or repeating):
+                return True
+        elif op == sre_parse.SUBPATTERN:
+            if _has_ambiguous_repeat(arg[-1], inside_repeat):
+                return True
+        elif op == sre_parse.BRANCH:
+            if inside_repeat:
+                firsts = [_first_chars(branch) for branch in arg[1]]
+                if None in firsts or _overlaps(firsts):
+                    return True
+            if any(_has_ambiguous_repeat(branch, inside_repeat) for branch in arg[1]):
+                return True
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            if _has_ambiguous_repeat(arg[1], inside_repeat):
+                return True
+    return False
+
+def _backtrack_cost(items):
+    """
+    估算从一个起点匹配失败时最多要试的拆法数：顺序排列的次数不定的重复各自的可选次数相乘
+    （无上限按 REGEX_MAX_TEXT 计；重复的内容本身有多种拆法时按轮数取幂），首字符互不相同的分支取最大值，否则相加。
+    多个重复连在一起（如 .*.*x、[ab]{0,10}.+\\w+a+x）不匹配时回溯次数是文本长度的多次方
+    """
+    cost = 1
+    for op, arg in items:
+        if op in _REPEATS:
+            low, high, sub = arg
+            # 每一轮各有 sub_cost 种拆法，最多 high 轮
+            high = min(high, REGEX_MAX_TEXT)
+            cost *= (high - low + 1) * _backtrack_cost(sub) ** high
+        elif op == sre_parse.SUBPATTERN:
+            cost *= _backtrack_cost(arg[-1])
+        elif op == sre_parse.BRANCH:
+            costs = [_backtrack_cost(branch) for branch in arg[1]]
+            firsts = [_first_chars(branch) for branch in arg[1]]
+            if None in firsts or _overlaps(firsts):
+                cost *= sum(costs)
+            else:
+                cost *= max(costs)
+        elif op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            cost *= _backtrack_cost(arg[1])
+        if cost > REGEX_MAX_STEPS:
+            break
+    return min(cost, REGEX_MAX_STEPS + 1)
+
+def _has_backref(items):
+    for op, arg in items:
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            return True
+        if op == sre_parse.SUBPATTERN and _has_backref(arg[-1]):
+            return True
+        if op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT) and _has_backref(arg[2]):
+            return True
+        if op == sre_parse.BRANCH and any(_has_backref(branch) for branch in arg[1]):
+            return True
+    return False
+
+def validate_regex(pattern):
+    """检查正则关键词能否安全地合并进群的组合正则，返回错误说明，没问题返回 None"""
+    if len(pattern) > REGEX_MAX_LENGTH:
+        return f"正则过长（最多 {REGEX_MAX_LENGTH} 个字符）"
+    try:
+        compiled = re.compile(pattern)
+        parsed = sre_parse.parse(pattern)
+    except re.error as e:
+        return f"正则语法错误：{e}"
+    if compiled.flags & ~re.UNICODE:
+        return "不支持全局标志，请改用 (?i:...) 这样的局部写法"
+    if compiled.groupindex:
+        return "不支持命名分组 (?P<name>...)"
+    if _has_backref(parsed):
+        return "不支持反向引用"
+    if _has_nested_repeat(parsed):
+        return "量词嵌套（如 (a+)+）可能导致匹配极慢，请改写"
+    if _has_ambiguous_repeat(parsed):
+        return "重复的分组里有能匹配空串或首字相同的分支（如 (a|aa)*、(a?)*），可能导致匹配极慢，请改写"
+    # 末尾能匹配空串的部分（如 优惠.* 的 .*）一旦走到必然成功，不会回溯，不计入
+    items = list(parsed)
+    while items and _nullable(items[-1:]):
+        items.pop()
+    if _backtrack_cost(items) * REGEX_MAX_TEXT > REGEX_MAX_STEPS:
+        return "次数不定的重复太多（如 .*.*、\\d+-\\d+），不匹配时回溯过多；不限次数的重复最多一个，其余请改用 {1,5} 这样上限较小的写法"
+    return None
+
+class AhoCorasick:
+    """
+    多模式子串匹配自动机。每个模式带一个名次（越小越优先），
+    search 扫描一遍文本，返回出现在文本中的模式里名次最小的一个，耗时与模式数量无关。
+    """
+
+    __slots__ = ("_goto", "_fail", "_best")
+
+    def __init__(self, patterns):
+        """patterns: [(模式字符串, 名次)]"""
+        self._goto = [{}]      # 状态 -> {字符: 下一状态}
+        self._fail = [0]
+        self._best = [None]    # 状态 -> 以该状态结尾（含后缀链接）的模式中最小的名次
+        for pattern, rank in patterns:
+            state = 0
+            for ch in pattern:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._best.append(None)
+                state = nxt
+            if self._best[state] is None or rank < self._best[state]:
+                self._best[state] = rank
+        self._build_links()
+
+    def _build_links(self):
+        # BFS 计算失败链接，并把失败状态上的最小名次合并进来
+        queue = list(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            fail_best = self._best[self._fail[state]]
+            if fail_best is not None and (self._best[state] is None or fail_best < self._best[state]):
+                self._best[state] = fail_best
+            for ch, nxt in self._goto[state].items():
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0)
+                queue.append(nxt)
+
+    def search(self, text):
+        """返回文本中出现的模式的最小名次，没有则返回 None"""
+        goto, fail, best_of = self._goto, self._fail, self._best
+        best = best_of[0]  # 空模式匹配任何文本
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            rank = best_of[state]
+            if rank is not None and (best is None or rank < best):
+                best = rank
+                if best == 0:
+                    break
+        return best
+
+def edit_distance(a, b):
+    """Levenshtein 编辑距离（插入、删除、替换各计 1）"""
+    if len(a) < len(b):
+        a, b = b, a
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+def _deletions(word, distance):
+    """word 删去至多 distance 个字得到的所有字符串（含 word 本身）"""
+    result = {word}
+    frontier = {word}
+    for _ in range(distance):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        result |= frontier
+    return result
+
+class DeletionIndex:
+    """
+    近似匹配索引（对称删除法）：两个字符串的编辑距离不超过 d 时，
+    各自删去至多 d 个字后必有相同的结果。建索引时把每个关键词的删除变体放进哈希表，
+    查询时只生成消息的删除变体去查表，再对少量候选计算真实编辑距离。
+    查询耗时取决于消息长度，与关键词数量无关；长度不在关键词长度范围内的消息直接跳过。
+    """
+
+    __slots__ = ("distance", "_variants", "_min_len", "_max_len")
+
+    def __init__(self, words, distance):
+        """words: [(关键词, 名次)]"""
+        self.distance = distance
+        self._variants = {}   # 删除变体 -> [(关键词, 名次)]
+        lengths = []
+        for word, rank in words:
+            lengths.append(len(word))
+            for variant in _deletions(word, distance):
+                self._variants.setdefault(variant, []).append((word, rank))
+        self._min_len = min(lengths, default=0)
+        self._max_len = max(lengths, default=-1)
+
+    def accepts(self, length):
+        """长度为 length 的消息是否可能命中（长度差超过 distance 必然不命中）"""
+        return self._min_len - self.distance <= length <= self._max_len + self.distance
+
+    def search(self, text):
+        """返回与 text 编辑距离不超过 distance 的关键词中最小的名次，没有则返回 None"""
+        if not self.accepts(len(text)):
+            return None
+        best = None
+        for variant in _deletions(text, self.distance):
+            for word, rank in self._variants.get(variant, ()):
+                if (best is None or rank < best) and edit_distance(text, word) <= self.distance:
+                    best = rank
+        return best
+
+def combine_regex(patterns):
+    """把 [(正则, 名次)] 合并成一个带命名分组的正则，分组名 k<名次> 用于找回命中的关键词"""
+    if not patterns:
+        return None
+    combined = "|".join(f"(?P<k{rank}>{pattern})" for pattern, rank in patterns)
+    if re2 is not None:
+        try:
+            return re2.compile(combined)
+        except Exception:
+            pass  # re2 不支持的语法（如环视）退回标准库
+    return re.compile(combined)
+
+class RegexSet:
+    """
+    一个群的正则关键词。组合正则一次 search 只能得到在消息中最先出现的命中，
+    不一定是名次最小的；命中后再用只含更靠前正则的组合正则继续查找，
+    直到没有更靠前的命中，结果与逐条按顺序匹配一致。前 n 条的组合正则按需编译并缓存。
+    """
+
+    __slots__ = ("_patterns", "_ranks", "_compiled")
+
+    def __init__(self, patterns):
+        """patterns: [(正则, 名次)]，按名次升序"""
+        self._patterns = patterns
+        self._ranks = [rank for _, rank in patterns]
+        self._compiled = {}   # 前 n 条 -> 组合正则
+
+    def _combined(self, count):
+        compiled = self._compiled.get(count)
+        if compiled is None:
+            compiled = self._compiled[count] = combine_regex(self._patterns[:count])
+        return compiled
+
+    def search(self, text, below=None):
+        """返回命中的正则中最小的名次（只考虑名次小于 below 的），没有则返回 None"""
+        text = text[:REGEX_MAX_TEXT]
+        count = len(self._ranks) if below is None else bisect.bisect_left(self._ranks, below)
+        best = None
+        while count:
+            found = self._combined(count).search(text)
+            if found is None:
+                break
+            best = min(int(name[1:]) for name, value in found.groupdict().items() if value is not None)
+            count = bisect.bisect_left(self._ranks, best)
+        return best
+
+class KeywordMatcher:
+    """
+    一个群的关键词匹配器：精准关键词用哈希表，包含关键词用 Aho-Corasick 自动机，
+    正则关键词合并成组合正则（RegexSet），只匹配消息的前 REGEX_MAX_TEXT 个字。
+    rows 的顺序即优先级，与逐条遍历、取第一条命中的结果一致（各种方式都按名次取最小）。
+    精准/包含关键词在构建时归一化（见 text_normalize），消息在匹配时归一化一次；
+    正则关键词匹配原始文本。归一化后相同的关键词只保留排在前面的一条，collapsed 为合并掉的条数。
+    近似关键词按允许的编辑距离分组，每组一个删除变体索引（DeletionIndex）；
+    超过 APPROX_MAX_LENGTH 的近似关键词（限制加入前添加的）按精准匹配处理。
+    扫描前先做预筛：精准关键词的长度集合、包含关键词的首字/尾字集合、前两字集合与最短长度、
+    近似关键词的长度范围，消息全部不满足时直接判定不命中（群里有正则关键词时不预筛）。
+    """
+
+    __slots__ = (
+        "rows", "collapsed", "_exact", "_contains", "_regex", "_approx",
+        "_exact_lengths", "_heads", "_tails", "_contains_min", "_singles", "_bigrams",
+    )
+
+    def __init__(self, rows):
+        self.rows = rows
+        self._exact = {}
+        contains = {}
+        regexes = []
+        approx = {}   # 编辑距离 -> {归一化关键词: 名次}
+        collapsed = 0
+        for rank, row in enumerate(rows):
+            if not row.get("enabled", True):
+                continue
+            mode = int(row.get("fuzzy") or 0)
+            if mode == MODE_REGEX:
+                # 不安全或无法编译的正则直接跳过，不影响该群其他关键词
+                if validate_regex(row["keyword"]) is None:
+                    regexes.append((row["keyword"], rank))
+                continue
+            keyword = normalize(row["keyword"])
+            if not keyword:
+                continue
+            if mode == MODE_APPROX and len(keyword) <= APPROX_MAX_LENGTH:
+                distance = min(int(row.get("max_distance") or 1), APPROX_MAX_DISTANCE)
+                target = approx.setdefault(distance, {})
+            else:
+                target = contains if mode == MODE_CONTAINS else self._exact
+            if keyword in target:
+                collapsed += 1
+            else:
+                target[keyword] = rank
+        self.collapsed = collapsed
+        self._contains = AhoCorasick(contains.items()) if contains else None
+        self._regex = RegexSet(regexes) if regexes else None
+        self._approx = [DeletionIndex(words.items(), distance) for distance, words in sorted(approx.items())]
+        self._exact_lengths = {len(keyword) for keyword in self._exact}
+        self._heads = frozenset(keyword[0] for keyword in contains)
+        self._tails = frozenset(keyword[-1] for keyword in contains)
+        self._contains_min = min(map(len, contains), default=0)
+        self._singles = frozenset(keyword for keyword in contains if len(keyword) == 1)
+        self._bigrams = frozenset(keyword[:2] for keyword in contains if len(keyword) > 1)
+
+    def _may_contain(self, text):
+        """先用首字/尾字集合快速排除，再看消息里是否出现某个包含关键词的前两个字"""
+        if len(text) < self._contains_min or self._heads.isdisjoint(text) or self._tails.isdisjoint(text):
+            return False
+        if not self._singles.isdisjoint(text):
+            return True
+        bigrams = self._bigrams
+        return any(text[i:i + 2] in bigrams for i in range(len(text) - 1))
+
+    def match(self, text):
+        """返回命中的关键词行，没有命中返回 None"""
+        PREFILTER_STATS["messages"] += 1
+        if not self._exact and self._contains is None and self._regex is None and not self._approx:
+            PREFILTER_STATS["rejected"] += 1
+            return None
+        normalized = normalize(text)
+        length = len(normalized)
+        contains = self._contains is not None and self._may_contain(normalized)
+        approx = [index for index in self._approx if index.accepts(length)]
+        if self._regex is None and not contains and not approx and length not in self._exact_lengths:
+            PREFILTER_STATS["rejected"] += 1
+            return None
+
+        best = self._exact.get(normalized)
+        if contains:
+            rank = self._contains.search(normalized)
+            if rank is not None and (best is None or rank < best):
+                best = rank
+        for index in approx:
+            rank = index.search(normalized)
+            if rank is not None and (best is None or rank < best):
+                best = rank
+        if self._regex is not None:
+            # 只需找比当前结果更靠前的正则
+            rank = self._regex.search(text, best)
+            if rank is not None:
+                best = rank
+        return self.rows[best] if best is not None else None
+
+# chat_id -> KeywordMatcher，关键词索引重建（该群关键词变化）时随之重建
+_matchers = {}
+
+def matcher_for(chat_id, rows):
+    """
+    取该群的匹配器。rows 来自 db.fetch_enabled_keywords，索引未变化时是同一个列表对象，
+    只需比较对象身份即可判断是否需要重建。
+    """
+    matcher = _matchers.get(chat_id)
+    if matcher is None or matcher.rows is not rows:
+        matcher = KeywordMatcher(rows)
+        _matchers[chat_id] = matcher
+    return matcher
@@ -0,0 +1,86 @@
+import asyncio
+import datetime
+import db
+from config import KEYWORD_STATS_FLUSH_INTERVAL
+from modules.keyword_matcher import prefilter_stats
+
+class KeywordStats:
+    """
+    关键词命中统计：每条消息只在内存里累加计数，
+    后台循环定期把这段时间的增量用一次批量 upsert 写入 keyword_stats 表。
+    hits 为命中并回复的次数，suppressed 为命中但被冷却/限流抑制的次数，last_hit 为最近一次命中时间。
+    """
+
+    def __init__(self, interval=KEYWORD_STATS_FLUSH_INTERVAL):
+        self.interval = interval
+        self._pending = {}   # (chat_id, keyword) -> [hits, suppressed, last_hit]
+        self._task = None
+
+    def record(self, chat_id, keyword, replied=True, now=None):
+        entry = self._pending.get((chat_id, keyword))
+        if entry is None:
+            entry = self._pending[(chat_id, keyword)] = [0, 0, None]
+        entry[0 if replied else 1] += 1
+        entry[2] = now or datetime.datetime.now()
+
+    def forget(self, chat_id, keyword):
+        """关键词被删除：丢弃尚未写入的增量"""
+        self._pending.pop((chat_id, keyword), None)
+
+    async def flush(self):
+        """写入累计的增量，返回写入的关键词数；写入失败时增量并回内存，下次重试"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        items = [(chat_id, keyword, hits, suppressed, last_hit)
+                 for (chat_id, keyword), (hits, suppressed, last_hit) in pending.items()]
+        if await db.add_keyword_stats(items):
+            return len(items)
+        for key, (hits, suppressed, last_hit) in pending.items():
+            entry = self._pending.setdefault(key, [0, 0, None])
+            entry[0] += hits
+            entry[1] += suppressed
+            entry[2] = max(entry[2] or last_hit, last_hit)
+        return 0
+
+    async def fetch(self, chat_id):
+        """该群的统计（数据库中的累计值加上尚未写入的增量），用于管理页展示"""
+        stats = await db.fetch_keyword_stats(chat_id)
+        for (cid, keyword), (hits, suppressed, last_hit) in self._pending.items():
+            if cid != chat_id:
+                continue
+            row = stats.setdefault(keyword, {"hits": 0, "suppressed": 0, "last_hit": None})
+            row["hits"] = (row["hits"] or 0) + hits
+            row["suppressed"] = (row["suppressed"] or 0) + suppressed
+            row["last_hit"] = db.to_db_time(last_hit)
+        return stats
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                if await self.flush():
+                    pf = prefilter_stats()
+                    print(
+                        f"[keyword_stats] 预筛跳过 {pf['rejected']}/{pf['messages']} 条消息"
+                        f"（{pf['hit_rate']:.1%}）",
+                        flush=True,
+                    )
+            except Exception as e:
+                print(f"[keyword_stats] 写入异常: {e}", flush=True)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # 退出前写入最后一批
+        await self.flush()
+
+KEYWORD_STATS = KeywordStats()
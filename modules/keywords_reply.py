@@ -1,28 +1,84 @@
-import asyncio
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton, Update
 from telegram.ext import ContextTypes, ConversationHandler
 import db
+from modules import outbox
+from modules.keyword_matcher import (
+    matcher_for, validate_regex, MODE_EXACT, MODE_CONTAINS, MODE_REGEX, MODE_APPROX,
+    APPROX_MAX_DISTANCE, APPROX_MAX_LENGTH,
+)
+from modules.keyword_limiter import REPLY_LIMITER
+from modules.keyword_stats import KEYWORD_STATS
+from modules.text_normalize import normalize
 
 # Conversation states
 KW_ADD = 500
 KW_EDIT = 501
 
-def build_keywords_text(kws: list, chat_name: str = "") -> str:
-    """格式化已添加的关键词列表文本"""
+# 添加关键词时的输入前缀 -> 匹配方式（列表中显示为 mode_mark）
+REGEX_PREFIX = "re:"
+APPROX_PREFIX = "~"   # 重复几次即允许几个错字，如“~~”为编辑距离 2
+
+# 按钮回调数据里带关键词的前缀；Telegram 限制回调数据最多 64 字节，按最长的前缀计算关键词可用的字节数
+KEYWORD_CALLBACK_PREFIXES = ("kw_remove_", "kw_enable_", "kw_disable_", "kw_delayset_", "kw_cdset_", "kw_edit_")
+KEYWORD_MAX_BYTES = 64 - max(len(prefix.encode()) for prefix in KEYWORD_CALLBACK_PREFIXES)
+
+def mode_mark(k: dict) -> str:
+    """列表中标记关键词匹配方式：- 精准、* 包含、re: 正则、~ 近似"""
+    mode = int(k.get("fuzzy") or 0)
+    if mode == MODE_REGEX:
+        return REGEX_PREFIX
+    if mode == MODE_APPROX:
+        return APPROX_PREFIX * int(k.get("max_distance") or 1)
+    return "*" if mode == MODE_CONTAINS else "-"
+
+def parse_keyword_input(text: str):
+    """解析管理员输入的关键词，返回 (关键词, 匹配方式, 近似匹配的最大编辑距离)"""
+    if text.startswith(REGEX_PREFIX):
+        return text[len(REGEX_PREFIX):].strip(), MODE_REGEX, 1
+    if text.startswith(APPROX_PREFIX):
+        keyword = text.lstrip(APPROX_PREFIX)
+        return keyword.strip(), MODE_APPROX, len(text) - len(keyword)
+    if text.startswith("*"):
+        return text.lstrip("*"), MODE_CONTAINS, 1
+    return text, MODE_EXACT, 1
+
+def equivalent_keyword(kws: list, keyword: str, mode: int):
+    """找出归一化后与新关键词相同、但写法不同的已有关键词（同一匹配方式）"""
+    target = normalize(keyword)
+    for k in kws:
+        if int(k.get("fuzzy") or 0) == mode and k["keyword"] != keyword and normalize(k["keyword"]) == target:
+            return k
+    return None
+
+def build_keywords_text(kws: list, chat_name: str = "", stats: dict = None) -> str:
+    """格式化已添加的关键词列表文本；stats 为 {keyword: 命中统计}"""
     if not kws:
         kw_list = "[空]"
     else:
         lines = []
         for k in kws:
-            prefix = "*" if k.get("fuzzy") else "-"
+            prefix = mode_mark(k)
             status = "✅" if k.get("enabled", True) else "❌"
             delay = k.get("delay", 0)
-            lines.append(f"{prefix} {k['keyword']} {status} 延时:{delay}分")
+            line = f"{prefix} {k['keyword']} {status} 延时:{delay}分"
+            cooldown = int(k.get("cooldown") or 0)
+            if cooldown > 0:
+                line += f" 冷却:{cooldown}秒"
+            if stats is not None:
+                st = stats.get(k["keyword"]) or {}
+                line += f" 命中:{st.get('hits') or 0}"
+                if st.get("suppressed"):
+                    line += f" 抑制:{st['suppressed']}"
+                # 只显示到分钟（MM-DD HH:MM）
+                line += f" 最近:{st['last_hit'][5:16]}" if st.get("last_hit") else " 最近:无"
+            lines.append(line)
         kw_list = "\n".join(lines)
     return (
         f"已添加的关键词:\n{kw_list}\n"
         "- 表示精准触发\n"
-        "* 表示包含触发"
+        "* 表示包含触发\n"
+        "re: 表示正则触发\n"
+        "~ 表示近似触发（~ 的个数为允许的错字数）"
     )
 
 def keyword_setting_menu() -> InlineKeyboardMarkup:
@@ -42,6 +98,16 @@ def keyword_setting_menu() -> InlineKeyboardMarkup:
             InlineKeyboardButton("10", callback_data="kw_delay_10"),
             InlineKeyboardButton("30", callback_data="kw_delay_30"),
         ],
+        [
+            InlineKeyboardButton("回复冷却(秒) ⏱", callback_data="noop"),
+        ],
+        [
+            InlineKeyboardButton("否", callback_data="kw_cd_0"),
+            InlineKeyboardButton("10", callback_data="kw_cd_10"),
+            InlineKeyboardButton("30", callback_data="kw_cd_30"),
+            InlineKeyboardButton("60", callback_data="kw_cd_60"),
+            InlineKeyboardButton("300", callback_data="kw_cd_300"),
+        ],
         [
             InlineKeyboardButton("👍🏻添加", callback_data="kw_add"),
             InlineKeyboardButton("🗑删除", callback_data="kw_remove"),
@@ -74,7 +140,8 @@ async def keywords_setting_entry(
     kws = await db.fetch_keywords(chat_id)
     now = __import__("datetime").datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     header = f"📝【{chat_name} 关键词管理】\n时间：{now}\n（此页可管理关键词自动回复）"
-    text = f"{header}\n\n{build_keywords_text(kws, chat_name)}"
+    stats = await KEYWORD_STATS.fetch(chat_id)
+    text = f"{header}\n\n{build_keywords_text(kws, chat_name, stats)}"
     markup = keyword_setting_menu()
 
     if update.callback_query:
@@ -94,7 +161,9 @@ async def kw_add_start(
         ]
     ]
     await update.callback_query.edit_message_text(
-        "【关键词管理 - 添加】\n请输入新关键词（前缀*为模糊匹配，如“*你好”）：",
+        "【关键词管理 - 添加】\n请输入新关键词（前缀*为模糊匹配，如“*你好”；"
+        "前缀re:为正则，如“re:^(你好|您好)$”；"
+        "前缀~为近似匹配，容忍一个错字，如“~退款流程”，“~~”容忍两个）：",
         reply_markup=InlineKeyboardMarkup(buttons),
     )
     return KW_ADD
@@ -109,9 +178,40 @@ async def kw_add_receive(
     # 第一步：输入关键词
     if step == "keyword":
         kw = update.message.text.strip()
-        if not kw:
+        keyword, mode, max_distance = parse_keyword_input(kw)
+        if not keyword:
             await update.message.reply_text("关键词不能为空，请重新输入：")
             return KW_ADD
+        if mode == MODE_APPROX:
+            # 关键词太短时，允许的错字数会让它几乎匹配任何同长度的消息
+            if max_distance > APPROX_MAX_DISTANCE:
+                await update.message.reply_text(f"最多容忍 {APPROX_MAX_DISTANCE} 个错字，请重新输入：")
+                return KW_ADD
+            if len(normalize(keyword)) > APPROX_MAX_LENGTH:
+                await update.message.reply_text(f"近似匹配的关键词最多 {APPROX_MAX_LENGTH} 个字，请重新输入：")
+                return KW_ADD
+            if len(normalize(keyword)) <= max_distance * 2:
+                await update.message.reply_text(
+                    f"容忍 {max_distance} 个错字时关键词至少需要 {max_distance * 2 + 1} 个字，请重新输入："
+                )
+                return KW_ADD
+        # 关键词是按钮回调数据的一部分，超过 Telegram 的 64 字节限制时整个按钮列表都发不出去
+        if len(keyword.encode()) > KEYWORD_MAX_BYTES:
+            await update.message.reply_text(
+                f"关键词过长（最多 {KEYWORD_MAX_BYTES} 字节，约 {KEYWORD_MAX_BYTES // 3} 个汉字），请重新输入："
+            )
+            return KW_ADD
+        if mode == MODE_REGEX:
+            error = validate_regex(keyword)
+            if error:
+                await update.message.reply_text(f"{error}，请重新输入：")
+                return KW_ADD
+        else:
+            # 全半角、大小写、繁简、空白不同的写法匹配时视为同一个关键词，不必重复添加
+            same = equivalent_keyword(await db.fetch_keywords(chat_id), keyword, mode)
+            if same:
+                await update.message.reply_text(f"已有等价的关键词：{mode_mark(same)} {same['keyword']}，请重新输入：")
+                return KW_ADD
         context.user_data["kw_new_keyword"] = kw
         context.user_data["kw_add_step"] = "reply"
         buttons = [
@@ -133,11 +233,12 @@ async def kw_add_receive(
         await update.message.reply_text("回复内容不能为空，请重新输入：")
         return KW_ADD
 
-    fuzzy = 1 if kw.startswith("*") else 0
-    keyword = kw.lstrip("*")
-    await db.add_keyword(chat_id, keyword, reply, fuzzy, enabled=1, delay=0)
+    keyword, mode, max_distance = parse_keyword_input(kw)
+    await db.add_keyword(chat_id, keyword, reply, mode, enabled=1, delay=0, max_distance=max_distance)
 
-    await update.message.reply_text(f"已添加关键词：{'*' if fuzzy else ''}{keyword}")
+    await update.message.reply_text(
+        f"已添加关键词：{mode_mark({'fuzzy': mode, 'max_distance': max_distance})} {keyword}"
+    )
     # 清理临时数据并返回管理页
     context.user_data.pop("kw_add_step", None)
     context.user_data.pop("kw_new_keyword", None)
@@ -157,7 +258,7 @@ async def kw_remove(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     buttons = [
         [
             InlineKeyboardButton(
-                f"{'*' if k['fuzzy'] else '-'} {k['keyword']}",
+                f"{mode_mark(k)} {k['keyword']}",
                 callback_data=f"kw_remove_{k['keyword']}"
             )
         ]
@@ -177,6 +278,7 @@ async def kw_remove_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE)
     chat_id = get_chat_id(update, context)
     keyword = update.callback_query.data.removeprefix("kw_remove_")
     await db.remove_keyword(chat_id, keyword)
+    KEYWORD_STATS.forget(chat_id, keyword)
     await keywords_setting_entry(update, context)
 
 async def kw_enable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -192,7 +294,7 @@ async def kw_enable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     buttons = [
         [
             InlineKeyboardButton(
-                f"{'*' if k['fuzzy'] else '-'} {k['keyword']}",
+                f"{mode_mark(k)} {k['keyword']}",
                 callback_data=f"kw_enable_{k['keyword']}"
             )
         ]
@@ -227,7 +329,7 @@ async def kw_disable(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     buttons = [
         [
             InlineKeyboardButton(
-                f"{'*' if k['fuzzy'] else '-'} {k['keyword']}",
+                f"{mode_mark(k)} {k['keyword']}",
                 callback_data=f"kw_disable_{k['keyword']}"
             )
         ]
@@ -264,7 +366,7 @@ async def kw_delay(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     buttons = [
         [
             InlineKeyboardButton(
-                f"{'*' if k['fuzzy'] else '-'} {k['keyword']}",
+                f"{mode_mark(k)} {k['keyword']}",
                 callback_data=f"kw_delayset_{k['keyword']}"
             )
         ]
@@ -287,6 +389,44 @@ async def kw_delayset_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE
     await db.update_keyword_delay(chat_id, keyword, delay)
     await keywords_setting_entry(update, context)
 
+async def kw_cooldown(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """设置回复冷却 - 选择关键词"""
+    chat_id = get_chat_id(update, context)
+    chat_name = get_chat_name(context, chat_id)
+    cooldown = int(update.callback_query.data.removeprefix("kw_cd_"))
+    context.user_data["kw_cooldown_set"] = cooldown
+
+    kws = await db.fetch_keywords(chat_id)
+    if not kws:
+        await update.callback_query.answer("没有关键词")
+        return
+
+    buttons = [
+        [
+            InlineKeyboardButton(
+                f"{mode_mark(k)} {k['keyword']}",
+                callback_data=f"kw_cdset_{k['keyword']}"
+            )
+        ]
+        for k in kws
+    ]
+    buttons.append([
+        InlineKeyboardButton("返回上一级", callback_data="back_to_prev"),
+        InlineKeyboardButton("主菜单", callback_data="main_menu"),
+    ])
+    await update.callback_query.edit_message_text(
+        f"【{chat_name} 关键词管理 - 回复冷却】\n请选择要设置冷却的关键词（当前{cooldown}秒，冷却期内再次命中不回复）：",
+        reply_markup=InlineKeyboardMarkup(buttons),
+    )
+
+async def kw_cooldownset_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """处理回复冷却确认"""
+    chat_id = get_chat_id(update, context)
+    keyword = update.callback_query.data.removeprefix("kw_cdset_")
+    cooldown = context.user_data.get("kw_cooldown_set", 0)
+    await db.update_keyword_cooldown(chat_id, keyword, cooldown)
+    await keywords_setting_entry(update, context)
+
 async def kw_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """编辑关键词 - 选择列表"""
     chat_id = get_chat_id(update, context)
@@ -300,7 +440,7 @@ async def kw_edit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     buttons = [
         [
             InlineKeyboardButton(
-                f"{'*' if k['fuzzy'] else '-'} {k['keyword']}",
+                f"{mode_mark(k)} {k['keyword']}",
                 callback_data=f"kw_edit_{k['keyword']}"
             )
         ]
@@ -327,6 +467,7 @@ async def kw_edit_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         if k["keyword"] == keyword:
             old_reply = k["reply"]
             fuzzy = k.get("fuzzy", 0)
+            mark = mode_mark(k)
             break
     else:
         await update.callback_query.answer("关键词不存在")
@@ -341,7 +482,7 @@ async def kw_edit_entry(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     ]
     await update.callback_query.edit_message_text(
         f"【{chat_name} 关键词管理 - 编辑】\n"
-        f"原关键词：{'*' if fuzzy else ''}{keyword}\n"
+        f"原关键词：{mark} {keyword}\n"
         f"原回复：{old_reply}\n\n"
         "请直接发送新的回复内容：",
         reply_markup=InlineKeyboardMarkup(buttons),
@@ -378,24 +519,21 @@ async def keyword_autoreply(
         return
 
     chat_id = update.effective_chat.id
-    kws = await db.fetch_keywords(chat_id)
+    kws = await db.fetch_enabled_keywords(chat_id)
     text = update.effective_message.text or ""
 
-    for item in kws:
-        if not item.get("enabled", True):
-            continue
-
-        match = (
-            (item.get("fuzzy") and item["keyword"] in text) or
-            (not item.get("fuzzy") and item["keyword"] == text)
-        )
-        if match:
-            msg = await update.message.reply_text(item["reply"])
-            delay = int(item.get("delay", 0))
-            if delay > 0:
-                await asyncio.sleep(delay * 60)
-                try:
-                    await msg.delete()
-                except Exception:
-                    pass
-            break
+    # 按关键词排序取第一条命中（精准：哈希表；包含：Aho-Corasick 自动机；正则：组合正则）
+    item = matcher_for(chat_id, kws).match(text)
+    if item:
+        # 关键词冷却期内或群内回复过多时不回复，只计数
+        replied = REPLY_LIMITER.allow(chat_id, item["keyword"], int(item.get("cooldown") or 0))
+        # 只累加内存计数，由后台定期批量写库
+        KEYWORD_STATS.record(chat_id, item["keyword"], replied)
+        if not replied:
+            return
+        # 回复写入发件箱，由 worker 发送（以及按 delay 分钟后删除）
+        await outbox.enqueue(chat_id, "message", {
+            "text": item["reply"],
+            "reply_to_message_id": update.effective_message.message_id,
+            "delete_after": int(item.get("delay", 0) or 0),
+        })
@@ -0,0 +1,256 @@
+import asyncio
+import collections
+import datetime
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import urllib.parse
+import httpx
+from telegram import InputFile
+import db
+from config import (
+    MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_MB, MEDIA_PREFETCH_AHEAD, MEDIA_PREFETCH_INTERVAL
+)
+
+# 当前启用的缓存（未配置 MEDIA_CACHE_DIR 时为 None，发送时直接使用原始 URL）
+_active = None
+
+def install(cache):
+    global _active
+    _active = cache
+
+def cached_input(media_url, attach=False):
+    """
+    外链已缓存到本地时返回可直接上传的 InputFile，否则返回 None。
+    放进 InputMedia（相册）时需要 attach=True，以 attach:// 引用上传的文件。
+    """
+    if _active is None or not isinstance(media_url, str) or not media_url.startswith("http"):
+        return None
+    return _active.input_file(media_url, attach)
+
+def _filename(url):
+    name = posixpath.basename(urllib.parse.urlparse(url).path)
+    return name or None
+
+class MediaCache:
+    """
+    外链媒体的本地缓存：文件按内容 sha256 存放（相同内容只存一份），
+    index.json 记录 URL -> 哈希；总大小超过上限时按最近使用时间淘汰（LRU）。
+    文件的 mtime 即最近使用时间，重启后 LRU 顺序不丢失。
+    """
+
+    def __init__(self, root=MEDIA_CACHE_DIR, max_bytes=MEDIA_CACHE_MAX_MB * 1024 * 1024):
+        self.root = root
+        self.objects = os.path.join(root, "objects")
+        self.max_bytes = max_bytes
+        self._urls = {}                              # url -> sha256
+        self._lru = collections.OrderedDict()        # sha256 -> 字节数（最久未用的在前）
+        self._size = 0
+        self._locks = {}
+        self.stats = {"hits": 0, "misses": 0, "downloads": 0, "download_errors": 0, "evictions": 0}
+        os.makedirs(self.objects, exist_ok=True)
+        self._load()
+
+    def _index_path(self):
+        return os.path.join(self.root, "index.json")
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def _load(self):
+        entries = []
+        for name in os.listdir(self.objects):
+            path = self._object_path(name)
+            st = os.stat(path)
+            if not st.st_size:
+                # 旧版本可能缓存过空文件，不能用于上传
+                os.remove(path)
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._lru[name] = size
+            self._size += size
+        try:
+            with open(self._index_path(), encoding="utf-8") as f:
+                urls = json.load(f)
+        except (OSError, ValueError):
+            urls = {}
+        self._urls = {url: digest for url, digest in urls.items() if digest in self._lru}
+
+    def _save_index(self):
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(self._urls, f)
+        os.replace(tmp, self._index_path())
+
+    def __contains__(self, url):
+        return url in self._urls
+
+    def path_for(self, url):
+        """已缓存时返回本地文件路径并标记为最近使用"""
+        digest = self._urls.get(url)
+        if digest is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        self._lru.move_to_end(digest)
+        path = self._object_path(digest)
+        try:
+            os.utime(path)
+        except OSError:
+            # 文件被外部删除
+            self._drop(digest)
+            self._save_index()
+            return None
+        return path
+
+    def input_file(self, url, attach=False):
+        """读取缓存文件构造上传用的 InputFile（InputFile 构造时即读入全部内容）"""
+        path = self.path_for(url)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return InputFile(f, filename=_filename(url), attach=attach)
+
+    async def fetch(self, url, client: httpx.AsyncClient):
+        """下载 url 到缓存（已缓存则跳过），返回是否可用"""
+        if url in self._urls:
+            return True
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        async with lock:
+            if url in self._urls:
+                return True
+            try:
+                digest, size = await self._download(url, client)
+            except Exception as e:
+                self.stats["download_errors"] += 1
+                print(f"[media_cache] 下载失败 {url}: {e}", flush=True)
+                return False
+            finally:
+                self._locks.pop(url, None)
+            self.stats["downloads"] += 1
+            if digest not in self._lru:
+                self._size += size
+            self._lru[digest] = size
+            self._lru.move_to_end(digest)
+            self._urls[url] = digest
+            self._evict()
+            self._save_index()
+            return url in self._urls
+
+    async def _download(self, url, client):
+        """流式写入临时文件并同时计算哈希，完成后按哈希改名"""
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                async with client.stream("GET", url, follow_redirects=True) as response:
+                    response.raise_for_status()
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise ValueError("文件超过缓存容量上限")
+                        digest.update(chunk)
+                        f.write(chunk)
+            if not size:
+                raise ValueError("源站返回空文件")
+            name = digest.hexdigest()
+            os.replace(tmp, self._object_path(name))
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+        return name, size
+
+    def _drop(self, digest):
+        self._size -= self._lru.pop(digest, 0)
+        self._urls = {url: d for url, d in self._urls.items() if d != digest}
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._lru:
+            digest = next(iter(self._lru))
+            self._drop(digest)
+            self.stats["evictions"] += 1
+
+    def usage(self):
+        return {"files": len(self._lru), "bytes": self._size, "urls": len(self._urls), **self.stats}
+
+class MediaPrefetcher:
+    """
+    定期扫描本实例负责的群中即将推送（ahead 秒内）的定时消息，
+    把外链媒体提前下载到 MediaCache，推送时不再等待源站。
+    已有 file_id 缓存的外链不需要再上传，跳过。
+    """
+
+    def __init__(self, cache, group_ids, coordinator=None,
+                 ahead=MEDIA_PREFETCH_AHEAD, interval=MEDIA_PREFETCH_INTERVAL, concurrency=4):
+        self.cache = cache
+        self.group_ids = list(group_ids)
+        self.coordinator = coordinator
+        self.ahead = ahead
+        self.interval = interval
+        self.concurrency = concurrency
+        self._task = None
+
+    async def upcoming_urls(self, now=None):
+        now = now or datetime.datetime.now()
+        # next_fire_at 为定长文本，字符串比较即时间比较
+        horizon = db.to_db_time(now + datetime.timedelta(seconds=self.ahead))
+        chat_ids = self.coordinator.owned() if self.coordinator else self.group_ids
+        urls = []
+        for chat_id in chat_ids:
+            for row in await db.fetch_schedules(chat_id):
+                url = row.get("media_url") or ""
+                if not url.startswith("http") or url in urls or url in self.cache:
+                    continue
+                fire_at = row.get("next_fire_at")
+                if not row.get("status") or not fire_at or fire_at > horizon:
+                    continue
+                if await db.fetch_media_file_id(f"url:{url}"):
+                    continue
+                urls.append(url)
+        return urls
+
+    async def run_once(self, client):
+        urls = await self.upcoming_urls()
+        if not urls:
+            return 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(url):
+            async with semaphore:
+                return await self.cache.fetch(url, client)
+
+        results = await asyncio.gather(*(fetch(url) for url in urls))
+        print(f"[media_cache] 预取 {sum(results)}/{len(urls)} 个媒体，缓存 {self.cache.usage()}", flush=True)
+        return sum(results)
+
+    async def _loop(self):
+        async with httpx.AsyncClient(timeout=60) as client:
+            while True:
+                try:
+                    await self.run_once(client)
+                except Exception as e:
+                    print(f"[media_cache] 预取异常: {e}", flush=True)
+                await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,226 @@
+import asyncio
+import collections
+import datetime
+import time
+import db
+from config import (
+    SEND_WORKERS, OUTBOX_WORKERS, OUTBOX_BATCH, OUTBOX_LEASE,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_POLL_INTERVAL
+)
+
+# kind -> (handler, after_batch)
+# handler(bot, row) 发送一条发件箱条目并返回消息 ID（发出多条时返回 ID 列表），失败时抛异常；
+# after_batch(rows, message_ids) 在每批发送完后调用（可选），用于批量回写
+_handlers = {}
+
+# 本进程入队后立即唤醒 worker，其他进程的入队靠轮询发现
+_wakeup = None
+
+def register_handler(kind, handler, after_batch=None):
+    _handlers[kind] = (handler, after_batch)
+
+def _get_wakeup():
+    global _wakeup
+    if _wakeup is None:
+        _wakeup = asyncio.Event()
+    return _wakeup
+
+def wake():
+    _get_wakeup().set()
+
+async def enqueue(chat_id, kind, payload=None, available_at=None):
+    """写入一条出站消息并唤醒 worker"""
+    await enqueue_many([{
+        "chat_id": chat_id, "kind": kind, "payload": payload or {}, "available_at": available_at,
+    }])
+
+async def enqueue_many(items):
+    await db.enqueue_outbox(items)
+    wake()
+
+async def dispatch_by_chat(items, handler, workers=SEND_WORKERS):
+    """
+    按 chat_id 分组并发执行 handler(item)：不同群并行（最多 workers 个），
+    同一群内保持原有顺序。返回与 items 一一对应的 (结果, 异常)。
+    """
+    by_chat = {}
+    for index, item in enumerate(items):
+        by_chat.setdefault(item["chat_id"], []).append(index)
+    results = [(None, None)] * len(items)
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def run_chat(indexes):
+        async with semaphore:
+            for index in indexes:
+                try:
+                    results[index] = (await handler(items[index]), None)
+                except Exception as e:
+                    results[index] = (None, e)
+
+    await asyncio.gather(*(run_chat(indexes) for indexes in by_chat.values()))
+    return results
+
+# ========================
+# 内置消息类型
+# ========================
+async def send_text(bot, row):
+    """kind=message：payload 含 text，可选 reply_to_message_id、delete_after（分钟）"""
+    payload = row["payload"]
+    msg = await bot.send_message(
+        chat_id=row["chat_id"],
+        text=payload["text"],
+        reply_to_message_id=payload.get("reply_to_message_id"),
+        allow_sending_without_reply=True,
+    )
+    return msg.message_id
+
+async def schedule_reply_deletions(rows, message_ids):
+    """每批发送完后一次性登记需要延时删除的消息，到期由 DeletionDrainer 删除"""
+    now = datetime.datetime.now()
+    await db.schedule_deletions([
+        (row["chat_id"], message_id, now + datetime.timedelta(minutes=delay))
+        for row, message_id in zip(rows, message_ids)
+        if (delay := int(row["payload"].get("delete_after") or 0)) > 0
+    ])
+
+register_handler("message", send_text, after_batch=schedule_reply_deletions)
+
+# ========================
+# worker 池
+# ========================
+class OutboxWorkerPool:
+    """
+    发件箱 worker 池：workers 个循环各自认领一批条目，
+    按群分组发送（不同群并行、同一群按顺序），再批量记录结果。
+    多个进程可以同时运行，认领互斥。
+    """
+
+    def __init__(self, bot, workers=OUTBOX_WORKERS, batch=OUTBOX_BATCH, lease=OUTBOX_LEASE,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, poll_interval=OUTBOX_POLL_INTERVAL):
+        self.bot = bot
+        self.workers = workers
+        self.batch = batch
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._tasks = []
+        self._maintenance_task = None
+        self._stopping = False
+        self._delivered_at = collections.deque(maxlen=100000)
+        self.stats = {"delivered": 0, "retried": 0, "failed": 0, "batches": 0}
+
+    def drain_rate(self, window: float = 60) -> float:
+        """最近 window 秒内每秒发送成功的条数"""
+        cutoff = time.monotonic() - window
+        return sum(1 for ts in self._delivered_at if ts >= cutoff) / window
+
+    async def _deliver(self, row):
+        entry = _handlers.get(row["kind"])
+        if entry is None:
+            raise RuntimeError(f"未知的发件箱类型: {row['kind']}")
+        return await entry[0](self.bot, row)
+
+    async def _renew_lease(self, ids):
+        """批次发送期间每隔 lease/3 秒续租，限速排队久的批次不会被其他 worker 重发"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            await db.renew_outbox(ids, datetime.datetime.now() + datetime.timedelta(seconds=self.lease))
+
+    async def run_batch(self):
+        """认领并发送一批，返回认领到的条数"""
+        lease_until = datetime.datetime.now() + datetime.timedelta(seconds=self.lease)
+        rows = await db.claim_outbox(self.batch, lease_until)
+        if not rows:
+            return 0
+        started = time.monotonic()
+        renewer = asyncio.create_task(self._renew_lease([row["id"] for row in rows]))
+        try:
+            outcomes = await dispatch_by_chat(rows, self._deliver)
+        finally:
+            renewer.cancel()
+        finished = []
+        now = datetime.datetime.now()
+        for row, (message_id, error) in zip(rows, outcomes):
+            if error is None:
+                self.stats["delivered"] += 1
+                self._delivered_at.append(time.monotonic())
+                if isinstance(message_id, list):
+                    message_id = message_id[0] if message_id else None
+                finished.append({"id": row["id"], "status": db.OUTBOX_DONE, "result_message_id": message_id})
+            elif row["attempts"] < self.max_attempts:
+                self.stats["retried"] += 1
+                # 指数退避
+                retry_at = now + datetime.timedelta(seconds=min(600, 5 * 2 ** (row["attempts"] - 1)))
+                finished.append({"id": row["id"], "status": db.OUTBOX_PENDING, "error": str(error), "available_at": retry_at})
+            else:
+                self.stats["failed"] += 1
+                print(f"[outbox] {row['kind']} #{row['id']} chat={row['chat_id']} 发送失败: {error}", flush=True)
+                finished.append({"id": row["id"], "status": db.OUTBOX_FAILED, "error": str(error)})
+        await db.finish_outbox(finished)
+        # 各类型的批量回写
+        for kind, (_, after_batch) in _handlers.items():
+            if after_batch is None:
+                continue
+            kind_rows = [(row, message_id) for row, (message_id, error) in zip(rows, outcomes)
+                         if row["kind"] == kind and error is None]
+            if kind_rows:
+                try:
+                    await after_batch([r for r, _ in kind_rows], [m for _, m in kind_rows])
+                except Exception as e:
+                    print(f"[outbox] {kind} 批量回写失败: {e}", flush=True)
+        self.stats["batches"] += 1
+        if len(rows) > 1:
+            print(
+                f"[outbox] 本批 {len(rows)} 条，耗时 {time.monotonic() - started:.2f}s，"
+                f"近一分钟 {self.drain_rate():.2f} 条/秒",
+                flush=True
+            )
+        return len(rows)
+
+    async def _worker(self):
+        wakeup = _get_wakeup()
+        while not self._stopping:
+            try:
+                claimed = await self.run_batch()
+            except Exception as e:
+                print(f"[outbox] worker 异常: {e}", flush=True)
+                claimed = 0
+            if claimed >= self.batch:
+                continue
+            try:
+                await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            wakeup.clear()
+
+    async def _maintenance(self):
+        while not self._stopping:
+            await asyncio.sleep(600)
+            await db.purge_outbox(datetime.datetime.now() - datetime.timedelta(days=1))
+
+    def start(self):
+        self._stopping = False
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(max(1, self.workers))]
+        self._maintenance_task = asyncio.create_task(self._maintenance())
+
+    async def stop(self, timeout: float = 10):
+        """等待正在发送的批次完成后退出，避免已发出的消息未记录而被重发"""
+        self._stopping = True
+        wake()
+        # 清理任务大部分时间在睡眠，直接取消，不必等它醒来
+        if self._maintenance_task:
+            self._maintenance_task.cancel()
+            try:
+                await self._maintenance_task
+            except asyncio.CancelledError:
+                pass
+            self._maintenance_task = None
+        done, pending = await asyncio.wait(self._tasks, timeout=timeout) if self._tasks else (set(), set())
+        for task in pending:
+            task.cancel()
+        for task in pending:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
@@ -0,0 +1,115 @@
+import asyncio
+import time
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+class TokenBucket:
+    """令牌桶：rate 为每秒补充的令牌数，capacity 为允许的突发量"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, count: int = 1) -> float:
+        """
+        预占 count 个令牌，返回需要等待的秒数。
+        令牌允许透支，后来的请求自然排在前面请求之后，协程间无需加锁。
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= count
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+def messages_sent(endpoint, data) -> int:
+    """
+    该请求会在聊天中发出几条消息。Telegram 的单群限额只针对发出的消息，
+    删除、置顶、编辑等请求返回 0，只受全局限速约束。
+    """
+    if endpoint == "sendMediaGroup":
+        return len(data.get("media") or ()) or 1
+    if endpoint in ("copyMessages", "forwardMessages"):
+        return len(data.get("message_ids") or ()) or 1
+    if endpoint.startswith("send") and endpoint != "sendChatAction":
+        return 1
+    if endpoint in ("copyMessage", "forwardMessage"):
+        return 1
+    return 0
+
+class TokenBucketRateLimiter(BaseRateLimiter):
+    """
+    所有出站请求共用的限速器，通过 ApplicationBuilder().rate_limiter() 挂到 application.bot 上，
+    定时推送、广播、关键词回复都会经过这里：
+    - 全局每秒 global_rate 条；
+    - 每个群每分钟 group_per_minute 条，私聊每秒 1 条（只计发出的消息，相册按张数计，见 messages_sent）；
+    - 遇到 RetryAfter 时全局暂停对应秒数后重试，最多 max_retries 次。
+    """
+
+    def __init__(self, global_rate: float = 25, group_per_minute: float = 20, max_retries: int = 3):
+        self.global_rate = global_rate
+        self.group_per_minute = group_per_minute
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._paused_until = 0.0
+        self.stats = {"requests": 0, "throttled": 0, "retry_after": 0}
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            try:
+                is_group = int(chat_id) < 0
+            except (TypeError, ValueError):
+                is_group = True  # @username 形式的频道/群
+            if is_group:
+                bucket = TokenBucket(self.group_per_minute / 60, self.group_per_minute)
+            else:
+                bucket = TokenBucket(1, 1)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _throttle(self, chat_id, sent=1):
+        waited = False
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            waited = True
+            await asyncio.sleep(pause)
+        if chat_id is not None and sent:
+            delay = self._chat_bucket(chat_id).reserve(sent)
+            if delay > 0:
+                waited = True
+                await asyncio.sleep(delay)
+        delay = self._global.reserve()
+        if delay > 0:
+            waited = True
+            await asyncio.sleep(delay)
+        if waited:
+            self.stats["throttled"] += 1
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        sent = messages_sent(endpoint, data)
+        self.stats["requests"] += 1
+        for attempt in range(self.max_retries + 1):
+            await self._throttle(chat_id, sent)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = float(e.retry_after)
+                print(f"[rate_limiter] {endpoint} chat={chat_id} 触发限流，暂停 {retry_after}s", flush=True)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
@@ -1,7 +1,8 @@
+import json
 import re
 from db import (
     fetch_schedules, fetch_schedule, create_schedule,
-    update_schedule_multi, delete_schedule
+    update_schedule_multi, delete_schedule, MEDIA_GROUP_MAX
 )
 from modules.keyboards import (
     schedule_list_menu, schedule_edit_menu, schedule_add_menu, group_select_menu
@@ -40,6 +41,71 @@ def parse_datetime_input(text):
         return text
     return None
 
+def media_summary(sch):
+    """媒体一栏的展示文字"""
+    if sch.get('media_group'):
+        try:
+            return f"相册（{len(json.loads(sch['media_group']))}项）"
+        except ValueError:
+            return "相册"
+    return '有' if sch.get('media_url') else '无'
+
+def media_from_message(message):
+    """从管理员发来的消息中取出 (媒体, media_type)；文字视为文件ID/URL，“无”表示不要媒体"""
+    if message.video:
+        return message.video.file_id, "video"
+    if message.photo:
+        return message.photo[-1].file_id, "photo"
+    if message.document:
+        return message.document.file_id, "document"
+    if message.text and message.text.strip().lower() != "无":
+        return message.text.strip(), ""
+    return "", ""
+
+def album_error(items):
+    if len(items) > MEDIA_GROUP_MAX:
+        return f"相册最多 {MEDIA_GROUP_MAX} 项。"
+    types = {item["type"] for item in items if item["type"]}
+    if "document" in types and len(types) > 1:
+        return "文件不能和图片/视频放在同一个相册中。"
+    return None
+
+async def receive_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """
+    接收媒体输入，返回 (media_url, media_type, media_group)；相册还在接收中时返回 None。
+    相册的每一项作为单独的消息到达（带相同的 media_group_id），逐项收集，管理员发送“完成”结束；
+    也可以一次发送多行外链组成相册。
+    """
+    message = update.message
+    items = context.user_data.get("album_items")
+    text = (message.text or "").strip()
+    if message.media_group_id or (items is not None and text != "完成"):
+        media, media_type = media_from_message(message)
+        if not media_type:
+            await message.reply_text("相册只能包含图片/视频/文件，全部发送后请输入“完成”。")
+            return None
+        if items is None:
+            items = context.user_data["album_items"] = []
+            await message.reply_text("正在接收相册，全部发送后请输入“完成”：")
+        items.append({"type": media_type, "media": media})
+        return None
+    if items is None:
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if len(lines) > 1 and all(line.startswith("http") for line in lines):
+            items = [{"type": "", "media": line} for line in lines]
+    else:
+        context.user_data.pop("album_items", None)
+    if items is None:
+        media, media_type = media_from_message(message)
+        return media, media_type, ""
+    error = album_error(items)
+    if error:
+        await message.reply_text(f"{error}请重新发送媒体：")
+        return None
+    if len(items) == 1:
+        return items[0]["media"], items[0]["type"], ""
+    return "", "", json.dumps(items)
+
 async def show_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, schedule_id: int, notice: str = ""):
     sch = await fetch_schedule(schedule_id)
     group_id = sch['chat_id'] if sch else None
@@ -49,7 +115,7 @@ async def show_edit_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, sch
         text += (
             f"状态：{'启用' if sch.get('status') else '禁用'}\n"
             f"文本：{sch.get('text', '')}\n"
-            f"媒体：{'有' if sch.get('media_url') else '无'}\n"
+            f"媒体：{media_summary(sch)}\n"
             f"按钮：{sch.get('button_text', '') or '无'}\n"
             f"重复：{sch.get('repeat_seconds', 0)//60}分钟\n"
             f"时间段：{sch.get('time_period', '全天')}\n"
@@ -113,6 +179,7 @@ async def entry_add_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("请选择要设置定时消息的群聊：", reply_markup=group_select_menu(GROUPS))
         return SELECT_GROUP
     context.user_data["new_schedule"] = {}
+    context.user_data.pop("album_items", None)
     if getattr(update, "callback_query", None):
         await update.callback_query.edit_message_text("请输入文本内容：")
     else:
@@ -122,27 +189,24 @@ async def entry_add_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE)
 @admin_only
 async def add_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['new_schedule']['text'] = update.message.text.strip()
-    await update.message.reply_text("请发送媒体（图片/视频/文件ID/URL），或输入“无”跳过：")
+    await update.message.reply_text("请发送媒体（图片/视频/文件ID/URL，可发送相册或多行URL），或输入“无”跳过：")
     return ADD_MEDIA
 
 @admin_only
 async def add_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    media = ""
-    media_type = ""
-    if update.message.video:
-        media = update.message.video.file_id
-        media_type = "video"
-    elif update.message.photo:
-        media = update.message.photo[-1].file_id
-        media_type = "photo"
-    elif update.message.document:
-        media = update.message.document.file_id
-        media_type = "document"
-    elif update.message.text and update.message.text.strip().lower() != "无":
-        media = update.message.text.strip()
-        media_type = ""
+    received = await receive_media(update, context)
+    if received is None:
+        return ADD_MEDIA
+    media, media_type, media_group = received
     context.user_data['new_schedule']['media_url'] = media
     context.user_data['new_schedule']['media_type'] = media_type
+    context.user_data['new_schedule']['media_group'] = media_group
+    if media_group:
+        # Telegram 相册不能带按钮，跳过按钮设置
+        context.user_data['new_schedule']['button_text'] = ""
+        context.user_data['new_schedule']['button_url'] = ""
+        await update.message.reply_text("已收到相册（相册不支持按钮）。\n请输入重复时间，单位分钟（如60）：")
+        return ADD_REPEAT
     await update.message.reply_text("请输入按钮文字和链接，用英文逗号分隔，如：更多内容,https://example.com\n如无需按钮请输入“无”：")
     return ADD_BUTTON
 
@@ -209,7 +273,7 @@ async def add_end_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     desc = (
         "【确认添加定时消息】\n"
         f"文本：{sch.get('text','')}\n"
-        f"媒体：{'✔️' if sch.get('media_url') else '✖️'}\n"
+        f"媒体：{media_summary(sch) if sch.get('media_group') else ('✔️' if sch.get('media_url') else '✖️')}\n"
         f"按钮：{('✔️' if sch.get('button_text') else '✖️')}\n"
         f"重复：每{sch.get('repeat_seconds',0)//60}分钟\n"
         f"时间段：{sch.get('time_period','全天')}\n"
@@ -288,29 +352,22 @@ async def edit_text_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def edit_media_entry(update: Update, context: ContextTypes.DEFAULT_TYPE):
     schedule_id = int(update.callback_query.data.split("_")[-1])
     context.user_data["edit_schedule_id"] = schedule_id
-    await update.callback_query.edit_message_text("请发送新的媒体（图片/视频/文件ID/URL），或输入“无”以删除：")
+    context.user_data.pop("album_items", None)
+    await update.callback_query.edit_message_text("请发送新的媒体（图片/视频/文件ID/URL，可发送相册或多行URL），或输入“无”以删除：")
     return EDIT_MEDIA
 
 @admin_only
 async def edit_media_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     schedule_id = context.user_data.get("edit_schedule_id")
-    media = ""
-    media_type = ""
-    if update.message.video:
-        media = update.message.video.file_id
-        media_type = "video"
-    elif update.message.photo:
-        media = update.message.photo[-1].file_id
-        media_type = "photo"
-    elif update.message.document:
-        media = update.message.document.file_id
-        media_type = "document"
-    elif update.message.text and update.message.text.strip().lower() != "无":
-        media = update.message.text.strip()
-        media_type = ""
-    await update_schedule_multi(schedule_id, media_url=media, media_type=media_type, last_sent_time=None)
+    received = await receive_media(update, context)
+    if received is None:
+        return EDIT_MEDIA
+    media, media_type, media_group = received
+    await update_schedule_multi(
+        schedule_id, media_url=media, media_type=media_type, media_group=media_group, last_sent_time=None
+    )
     sch = await fetch_schedule(schedule_id)
-    if sch and sch['media_url'] == media:
+    if sch and sch['media_url'] == media and (sch.get('media_group') or "") == media_group:
         await show_edit_menu(update, context, schedule_id=schedule_id, notice="✅ 媒体已成功修改。")
     else:
         await show_edit_menu(update, context, schedule_id=schedule_id, notice="⚠️ 媒体未修改成功，请重试。")
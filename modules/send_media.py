@@ -1,55 +1,246 @@
+import asyncio
+import hashlib
 import mimetypes
+import os
+from telegram import InputMediaAudio, InputMediaDocument, InputMediaPhoto, InputMediaVideo
+from telegram.error import BadRequest
+import db
+from modules import media_cache
+
+# media_type -> (发送方法, 参数名, 是否支持 caption 和按钮)
+_SENDERS = {
+    "photo": ("send_photo", "photo", True),
+    "video": ("send_video", "video", True),
+    "animation": ("send_animation", "animation", True),
+    "sticker": ("send_sticker", "sticker", False),
+    "document": ("send_document", "document", True),
+}
+
+# (路径, mtime, 大小) -> 内容哈希，文件没变就不重复计算
+_file_hashes = {}
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+async def media_cache_key(media_url):
+    """
+    外链按 URL、本地文件按内容哈希生成 file_id 缓存键；
+    本身就是 file_id 或其他输入时返回 None（无需缓存）。
+    """
+    if not isinstance(media_url, str) or not media_url:
+        return None
+    if media_url.startswith(("http://", "https://")):
+        return f"url:{media_url}"
+    if os.path.isfile(media_url):
+        st = os.stat(media_url)
+        memo = (os.path.abspath(media_url), st.st_mtime_ns, st.st_size)
+        digest = _file_hashes.get(memo)
+        if digest is None:
+            digest = await asyncio.to_thread(_hash_file, media_url)
+            _file_hashes[memo] = digest
+        return f"sha256:{digest}"
+    return None
+
+def sent_file_id(msg):
+    """从发出的消息中取出 (media_type, file_id)，不是媒体消息时返回 None"""
+    if msg is None:
+        return None
+    if msg.photo:
+        return "photo", msg.photo[-1].file_id
+    # 动图消息同时带有 document 字段，需先于 document 判断
+    for media_type in ("animation", "video", "sticker", "document"):
+        media = getattr(msg, media_type, None)
+        if media is not None:
+            return media_type, media.file_id
+    return None
+
+async def _send_as(bot, media_type, chat_id, media, caption=None, reply_markup=None, **kwargs):
+    method, param, captioned = _SENDERS.get(media_type, _SENDERS["document"])
+    params = {param: media}
+    if captioned:
+        params.update(caption=caption, reply_markup=reply_markup)
+    return await getattr(bot, method)(chat_id=chat_id, **params, **kwargs)
+
+# 媒体引用 -> 上次发送成功的 media_type（media_type 为空的 file_id 等也能一次发出）
+_resolved_types = {}
+
+# 每次 send_media 调用了几次发送接口（含失败的尝试）
+SEND_MEDIA_STATS = {"sends": 0, "attempts": 0, "failed": 0, "by_attempts": {}}
+
+def _record_attempts(attempts, ok):
+    SEND_MEDIA_STATS["sends"] += 1
+    SEND_MEDIA_STATS["attempts"] += attempts
+    if not ok:
+        SEND_MEDIA_STATS["failed"] += 1
+    by_attempts = SEND_MEDIA_STATS["by_attempts"]
+    by_attempts[attempts] = by_attempts.get(attempts, 0) + 1
+
+def send_media_stats():
+    """发送次数、总尝试次数、平均每次发送的接口调用数，以及 {尝试次数: 发送次数} 分布"""
+    sends = SEND_MEDIA_STATS["sends"]
+    return {
+        "sends": sends,
+        "attempts": SEND_MEDIA_STATS["attempts"],
+        "failed": SEND_MEDIA_STATS["failed"],
+        "avg_attempts": SEND_MEDIA_STATS["attempts"] / sends if sends else 0.0,
+        "by_attempts": dict(sorted(SEND_MEDIA_STATS["by_attempts"].items())),
+    }
+
+def resolved_media_type(media_url):
+    """media_url 最近一次发送成功时使用的 media_type，未发送过时返回 None"""
+    return _resolved_types.get(media_url)
+
+def _guess_type(media_url):
+    """外链按扩展名猜测类型"""
+    mime, _ = mimetypes.guess_type(media_url)
+    if mime and mime.startswith("image/"):
+        return "photo"
+    if mime and mime.startswith("video/"):
+        return "video"
+    return "document"
+
+def _candidate_types(media_url, media_type):
+    """依次尝试的发送方式：指定的 media_type > 已学到的 > 按扩展名猜测 > document/video/photo"""
+    candidates = [media_type, _resolved_types.get(media_url)]
+    if isinstance(media_url, str) and media_url.startswith("http"):
+        candidates.append(_guess_type(media_url))
+    candidates += ["document", "video", "photo"]
+    ordered = []
+    for candidate in candidates:
+        if not candidate:
+            continue
+        candidate = candidate if candidate in _SENDERS else "document"
+        if candidate not in ordered:
+            ordered.append(candidate)
+    return ordered
+
+def _local_or_url(media_url, attach=False):
+    """本地缓存可用时返回缓存文件，读取失败（文件损坏、被删除等）时退回原始 URL"""
+    try:
+        return media_cache.cached_input(media_url, attach) or media_url
+    except Exception as e:
+        print(f"[send_media] 读取本地缓存失败，改用原始地址 {media_url}: {e}")
+        return media_url
 
 async def send_media(bot, chat_id, media_url, caption=None, buttons=None, media_type=None, **kwargs):
     """
     智能发送媒体消息，自动判别类型，支持 file_id / URL / 本地文件路径，并兼容 inline button。
+    URL 和本地文件首次发送成功后缓存 file_id，之后复用而不再上传；
+    media_type 为空时记住成功的发送方式（见 resolved_media_type），之后只调用一次接口。
     """
     reply_markup = buttons if buttons else None
-    # 优先用 media_type
-    if media_type:
-        try:
-            if media_type == "photo":
-                return await bot.send_photo(chat_id=chat_id, photo=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            elif media_type == "video":
-                return await bot.send_video(chat_id=chat_id, video=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            elif media_type == "animation":
-                return await bot.send_animation(chat_id=chat_id, animation=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            elif media_type == "sticker":
-                return await bot.send_sticker(chat_id=chat_id, sticker=media_url, **kwargs)
-            elif media_type in ["document", "file"]:
-                return await bot.send_document(chat_id=chat_id, document=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            else:
-                return await bot.send_document(chat_id=chat_id, document=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-        except Exception as e:
-            print(f"[send_media] 按 media_type 发送失败: {e}")
+    attempts = 0
+    key = await media_cache_key(media_url)
+    if key:
+        cached = await db.fetch_media_file_id(key)
+        if cached:
+            attempts += 1
+            try:
+                msg = await _send_as(
+                    bot, cached["media_type"], chat_id, cached["file_id"],
+                    caption=caption, reply_markup=reply_markup, **kwargs
+                )
+                _resolved_types[media_url] = cached["media_type"]
+                _record_attempts(attempts, True)
+                return msg
+            except BadRequest as e:
+                # file_id 失效：删掉缓存，重新上传
+                print(f"[send_media] 缓存的 file_id 不可用，重新上传: {e}")
+                await db.forget_media_file_id(key)
+            except Exception as e:
+                print(f"[send_media] 按缓存 file_id 发送失败: {e}")
+                _record_attempts(attempts, False)
+                return None
 
-    # 如果是外链，猜测类型
-    if isinstance(media_url, str) and media_url.startswith("http"):
-        mime, _ = mimetypes.guess_type(media_url)
+    errors = []
+    for candidate in _candidate_types(media_url, media_type):
+        attempts += 1
+        # 外链已预取到本地缓存时直接上传本地副本，不依赖源站
+        media = _local_or_url(media_url)
         try:
-            if not mime:
-                return await bot.send_document(chat_id=chat_id, document=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            if mime.startswith('image/'):
-                return await bot.send_photo(chat_id=chat_id, photo=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            elif mime.startswith('video/'):
-                return await bot.send_video(chat_id=chat_id, video=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            else:
-                return await bot.send_document(chat_id=chat_id, document=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
+            msg = await _send_as(bot, candidate, chat_id, media, caption=caption, reply_markup=reply_markup, **kwargs)
         except Exception as e:
-            print(f"[send_media] mimetype 发送失败: {e}")
+            errors.append(f"{candidate}:{e}")
+            continue
+        _resolved_types[media_url] = candidate
+        _record_attempts(attempts, True)
+        if key:
+            sent = sent_file_id(msg)
+            if sent:
+                await db.save_media_file_id(key, sent[1], candidate)
+        return msg
+    print(f"[send_media] 所有发送方式均失败: {' '.join(errors)}")
+    _record_attempts(attempts, False)
+    return None
 
-    # fallback: document, video, photo
-    try:
-        return await bot.send_document(chat_id=chat_id, document=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-    except Exception as e1:
+# 相册支持的类型；动图、贴纸等不能放进相册，按视频/图片处理
+_GROUP_MEDIA = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "animation": InputMediaVideo,
+    "document": InputMediaDocument,
+    "audio": InputMediaAudio,
+}
+
+def _group_item_type(item):
+    media_type = item.get("type") or ""
+    if media_type in _GROUP_MEDIA:
+        return media_type
+    media = item.get("media") or ""
+    if isinstance(media, str) and media.startswith("http"):
+        return _guess_type(media)
+    return "photo"
+
+async def send_media_group(bot, chat_id, items, caption=None, **kwargs):
+    """
+    一次 sendMediaGroup 发出整个相册（2~10 项，caption 挂在第一项上），返回发出的消息列表，失败返回 None。
+    items 为 [{"type": ..., "media": ...}]；与单条媒体一样复用 file_id 缓存和本地预取缓存。
+    """
+    types = [_group_item_type(item) for item in items]
+    keys = [await media_cache_key(item.get("media")) for item in items]
+    cached = [await db.fetch_media_file_id(key) if key else None for key in keys]
+    attempts = 0
+    for use_cache in (True, False):
+        if not use_cache and not any(cached):
+            break
+        media = []
+        for index, (item, media_type) in enumerate(zip(items, types)):
+            if use_cache and cached[index]:
+                source = cached[index]["file_id"]
+            else:
+                # 相册里的本地文件须以 attach:// 引用，否则请求中会丢掉 media 字段
+                source = _local_or_url(item["media"], attach=True)
+            media.append(_GROUP_MEDIA[media_type](
+                media=source, caption=caption if index == 0 else None
+            ))
+        attempts += 1
         try:
-            return await bot.send_video(chat_id=chat_id, video=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-        except Exception as e2:
-            try:
-                return await bot.send_photo(chat_id=chat_id, photo=media_url, caption=caption, reply_markup=reply_markup, **kwargs)
-            except Exception as e3:
-                print(f"[send_media] fallback all failed: doc:{e1} video:{e2} photo:{e3}")
-                return None
+            messages = await bot.send_media_group(chat_id=chat_id, media=media, **kwargs)
+        except BadRequest as e:
+            if use_cache and any(cached):
+                # 可能是缓存的 file_id 失效：删掉缓存，重新上传
+                print(f"[send_media_group] 使用缓存 file_id 发送失败，重新上传: {e}")
+                for key, hit in zip(keys, cached):
+                    if hit:
+                        await db.forget_media_file_id(key)
+                continue
+            print(f"[send_media_group] 发送失败: {e}")
+            break
+        except Exception as e:
+            print(f"[send_media_group] 发送失败: {e}")
+            break
+        _record_attempts(attempts, True)
+        for key, media_type, msg in zip(keys, types, messages):
+            sent = sent_file_id(msg)
+            if key and sent:
+                await db.save_media_file_id(key, sent[1], media_type)
+        return list(messages)
+    _record_attempts(attempts, False)
+    return None
 
 async def delete_message(bot, chat_id, message_id):
     """
@@ -60,6 +251,23 @@ async def delete_message(bot, chat_id, message_id):
     except Exception as e:
         print(f"[delete_message] 删除消息失败: {e}")
 
+async def delete_messages(bot, chat_id, message_ids):
+    """
+    删除多条消息（如整个相册）。PTB 提供 delete_messages（Bot API 7.0+，每次最多 100 条）时批量删除，
+    否则逐条删除。
+    """
+    message_ids = [mid for mid in message_ids if mid]
+    batch_delete = getattr(bot, "delete_messages", None)
+    if batch_delete is None or len(message_ids) < 2:
+        for message_id in message_ids:
+            await delete_message(bot, chat_id, message_id)
+        return
+    for start in range(0, len(message_ids), 100):
+        try:
+            await batch_delete(chat_id=chat_id, message_ids=message_ids[start:start + 100])
+        except Exception as e:
+            print(f"[delete_messages] 批量删除失败: {e}")
+
 async def pin_message(bot, chat_id, message_id, disable_notification=True):
     """
     置顶消息
@@ -0,0 +1,69 @@
+import asyncio
+import zlib
+import db
+from config import SHARD_LEASE_TTL
+
+def rendezvous_owner(key, instances):
+    """最高随机权重（rendezvous）哈希：实例增减时只有它负责的群会换主"""
+    return max(instances, key=lambda inst: zlib.crc32(f"{inst}:{key}".encode()))
+
+class ShardCoordinator:
+    """
+    多实例分片：每个实例定期在 bot_instances 表续约，
+    按存活实例列表用 rendezvous 哈希把群组分给各实例。
+    实例下线（租约过期）后，它负责的群自动分给其余实例。
+    """
+
+    def __init__(self, group_ids, instance_id=None, ttl=SHARD_LEASE_TTL, on_change=None):
+        self.group_ids = list(group_ids)
+        self.instance_id = instance_id or db.INSTANCE_ID
+        self.ttl = ttl
+        self.on_change = on_change
+        self.instances = []
+        self._owned = []
+        self._task = None
+
+    def owned(self):
+        return list(self._owned)
+
+    async def refresh(self):
+        instances = await db.heartbeat_instance(self.instance_id, self.ttl)
+        if instances is None:
+            # 数据库暂不可用，沿用上次的分配
+            return
+        if self.instance_id not in instances:
+            instances = sorted(instances + [self.instance_id])
+        owned = [gid for gid in self.group_ids if rendezvous_owner(gid, instances) == self.instance_id]
+        changed = owned != self._owned
+        self.instances = instances
+        self._owned = owned
+        if changed:
+            print(
+                f"[sharding] 实例 {self.instance_id} 负责 {len(owned)}/{len(self.group_ids)} 个群"
+                f"（存活实例 {len(instances)} 个）",
+                flush=True
+            )
+            if self.on_change:
+                self.on_change(owned)
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(max(1, self.ttl / 3))
+            try:
+                await self.refresh()
+            except Exception as e:
+                print(f"[sharding] 续约失败: {e}", flush=True)
+
+    async def start(self):
+        await self.refresh()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await db.remove_instance(self.instance_id)
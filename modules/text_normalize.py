@@ -0,0 +1,54 @@
+import re
+import unicodedata
+from config import KEYWORD_NORMALIZE
+
+try:
+    import opencc
+except ImportError:  # 繁简转换为可选功能
+    opencc = None
+
+_SPACES = re.compile(r"\s+")
+
+def _t2s_converter():
+    if opencc is None:
+        print("[text_normalize] 未安装 opencc，跳过繁简转换（pip install opencc）", flush=True)
+        return None
+    for config in ("t2s", "t2s.json"):
+        try:
+            return opencc.OpenCC(config).convert
+        except Exception:
+            continue
+    print("[text_normalize] opencc 初始化失败，跳过繁简转换", flush=True)
+    return None
+
+def build_pipeline(steps):
+    """
+    按名称组装归一化步骤：
+    nfkc     全角转半角、兼容字符统一（ＡＢＣ１ -> ABC1）
+    casefold 忽略大小写
+    t2s      繁体转简体（需要 opencc）
+    space    连续空白合并为一个空格并去掉首尾空白
+    """
+    funcs = []
+    for step in steps:
+        if step == "nfkc":
+            funcs.append(lambda s: unicodedata.normalize("NFKC", s))
+        elif step == "casefold":
+            funcs.append(str.casefold)
+        elif step == "t2s":
+            convert = _t2s_converter()
+            if convert:
+                funcs.append(convert)
+        elif step == "space":
+            funcs.append(lambda s: _SPACES.sub(" ", s).strip())
+        elif step:
+            print(f"[text_normalize] 未知的归一化步骤: {step}", flush=True)
+    return funcs
+
+_pipeline = build_pipeline(s.strip() for s in KEYWORD_NORMALIZE.split(","))
+
+def normalize(text):
+    """关键词与消息使用同一套归一化，匹配前各做一次"""
+    for func in _pipeline:
+        text = func(text)
+    return text
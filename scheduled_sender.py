@@ -1,122 +1,337 @@
 import asyncio
+import collections
 import datetime
-from db import fetch_schedules, update_schedule_multi
-from modules.send_media import send_media, delete_message, pin_message
+import heapq
+import json
+import time
+from config import (
+    SCHEDULE_BATCH_LIMIT, SCHEDULE_MAX_SLEEP, SCHEDULE_MIN_SLEEP, SCHEDULE_CLAIM_LEASE, SCHEDULE_PIPELINE
+)
+from db import (
+    claim_due_schedules, fetch_next_fire_times, fetch_schedule, update_schedules_sent,
+    update_schedule_media_type, cached_schedule_object,
+    on_schedule_change, off_schedule_change, to_db_time, SCHEDULE_BOOKKEEPING_FIELDS
+)
+from modules.compiled_schedule import CompiledSchedule, parse_db_time
+from modules.send_media import delete_messages, pin_message, resolved_media_type, send_media_stats
+from modules import outbox
+from modules.outbox import register_handler
 
-def parse_time_period(time_period: str):
-    """解析时间段字符串，返回起止时间（时分）元组"""
-    if not time_period:
-        return None, None
-    try:
-        start_str, end_str = time_period.split("-")
-        start_h, start_m = map(int, start_str.split(":"))
-        end_h, end_m = map(int, end_str.split(":"))
-        return (start_h, start_m), (end_h, end_m)
-    except Exception:
-        return None, None
-
-def check_in_period(now: datetime.datetime, time_period: str):
-    """判断当前时间是否在指定时段内"""
-    if not time_period:
-        return True
-    (start, end) = parse_time_period(time_period)
-    if not start or not end:
-        return True
-    now_min = now.hour * 60 + now.minute
-    start_min = start[0] * 60 + start[1]
-    end_min = end[0] * 60 + end[1]
-    if start_min <= end_min:
-        return start_min <= now_min < end_min
+class SendHistogram:
+    """最近 window 秒内每秒的推送条数（环形缓冲），用于观察出站负载是否平滑"""
+
+    def __init__(self, window: int = 3600):
+        self.window = window
+        self._counts = [0] * window
+        self._seconds = [0] * window
+
+    def record(self, ts: float = None):
+        second = int(ts if ts is not None else time.time())
+        index = second % self.window
+        if self._seconds[index] != second:
+            self._seconds[index] = second
+            self._counts[index] = 0
+        self._counts[index] += 1
+
+    def snapshot(self, now: float = None):
+        """返回 {epoch 秒: 条数}，只包含窗口内有推送的秒"""
+        now = int(now if now is not None else time.time())
+        return {
+            second: count
+            for second, count in zip(self._seconds, self._counts)
+            if count and now - second < self.window
+        }
+
+    def summary(self, now: float = None):
+        counts = list(self.snapshot(now).values())
+        if not counts:
+            return {"seconds": 0, "total": 0, "peak": 0, "mean": 0.0}
+        return {
+            "seconds": len(counts),
+            "total": sum(counts),
+            "peak": max(counts),
+            "mean": sum(counts) / len(counts),
+        }
+
+SEND_HISTOGRAM = SendHistogram()
+
+def send_histogram():
+    """每秒推送条数直方图：{条数: 出现该条数的秒数}"""
+    histogram = {}
+    for count in SEND_HISTOGRAM.snapshot().values():
+        histogram[count] = histogram.get(count, 0) + 1
+    return dict(sorted(histogram.items()))
+
+class LatencyStats:
+    """单条定时消息推送耗时（删除上一条 + 发送 + 置顶）的滑动窗口，按推送方式分开统计"""
+
+    def __init__(self, window: int = 1000):
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.last = {}   # schedule_id -> 最近一次耗时（秒）
+
+    def record(self, schedule_id, seconds: float, mode: str):
+        self._samples[mode].append(seconds)
+        self.last[schedule_id] = seconds
+
+    def summary(self):
+        """{推送方式: {count, mean, p50, p95, max}}，单位秒"""
+        result = {}
+        for mode, samples in self._samples.items():
+            ordered = sorted(samples)
+            if not ordered:
+                continue
+            result[mode] = {
+                "count": len(ordered),
+                "mean": sum(ordered) / len(ordered),
+                "p50": ordered[len(ordered) // 2],
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "max": ordered[-1],
+            }
+        return result
+
+DELIVERY_LATENCY = LatencyStats()
+
+def delivery_latency():
+    return DELIVERY_LATENCY.summary()
+
+class ScheduleQueue:
+    """
+    按下一次推送时间排列的最小堆，只负责决定调度循环睡多久。
+    到期的具体内容以数据库 next_fire_at 为准（claim_due_schedules 一次查询认领），
+    db 写操作通过变更回调提前唤醒循环。
+    堆里到期却没有被认领的条目（已删除、已停用、被其他实例认领或查询失败）按指数退避推迟，
+    避免循环在同一条目上空转。
+    """
+
+    def __init__(self):
+        self._heap = []       # (fire_at, schedule_id)
+        self._fire_at = {}    # schedule_id -> 最新的 fire_at，用于惰性删除旧条目
+        self._misses = {}     # schedule_id -> 连续到期未认领的次数
+        self._wakeup = asyncio.Event()
+
+    def __len__(self):
+        return len(self._fire_at)
+
+    def push(self, schedule_id, fire_at):
+        if fire_at is None:
+            self.discard(schedule_id)
+            return
+        self._fire_at[schedule_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, schedule_id))
+
+    def discard(self, schedule_id):
+        """移除条目（堆中的旧元组惰性删除）"""
+        self._fire_at.pop(schedule_id, None)
+        self._misses.pop(schedule_id, None)
+
+    def claimed(self, schedule_id, fire_at):
+        """认领成功后记录下一次推送时间"""
+        self._misses.pop(schedule_id, None)
+        self.push(schedule_id, fire_at)
+
+    def defer_unclaimed(self, now: datetime.datetime, claimed_ids):
+        """
+        到期但本轮没有认领到的条目推迟 1、2、4…秒（最多 SCHEDULE_MAX_SLEEP）后再试。
+        只从堆顶弹出到期的条目，耗时与到期条目数成正比，与定时消息总数无关
+        """
+        keep = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, schedule_id = heapq.heappop(self._heap)
+            if self._fire_at.get(schedule_id) != fire_at:
+                continue  # 已被替换或移除的旧元组
+            if schedule_id in claimed_ids:
+                keep.append((fire_at, schedule_id))
+                continue
+            misses = self._misses.get(schedule_id, 0)
+            self._misses[schedule_id] = misses + 1
+            self._fire_at[schedule_id] = retry_at = now + datetime.timedelta(
+                seconds=min(2 ** misses, SCHEDULE_MAX_SLEEP)
+            )
+            heapq.heappush(self._heap, (retry_at, schedule_id))
+        for item in keep:
+            heapq.heappush(self._heap, item)
+
+    def reset(self, fire_times):
+        """按数据库中的 (schedule_id, next_fire_at) 重新填充"""
+        self._heap.clear()
+        self._fire_at.clear()
+        self._misses.clear()
+        for schedule_id, fire_at in fire_times:
+            parsed = parse_db_time(fire_at)
+            if parsed:
+                self.push(schedule_id, parsed)
+
+    def mark_dirty(self, schedule_id, fields=None):
+        """db 变更回调：配置被修改的定时消息已在库里标记为立即到期"""
+        if fields and set(fields) <= SCHEDULE_BOOKKEEPING_FIELDS:
+            return
+        # 删除、停用或修改配置：旧的推送时间作废，仍可推送的会在下一轮认领时重新加入
+        if schedule_id is not None:
+            self.discard(schedule_id)
+        self._wakeup.set()
+
+    def seconds_until_next(self, now: datetime.datetime):
+        while self._heap:
+            fire_at, schedule_id = self._heap[0]
+            if self._fire_at.get(schedule_id) == fire_at:
+                return max(0.0, (fire_at - now).total_seconds())
+            heapq.heappop(self._heap)
+        return None
+
+    async def wait(self, timeout):
+        """睡到下一条到期或被变更唤醒"""
+        if timeout is not None and timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._wakeup.clear()
+
+def compile_schedule(row: dict) -> CompiledSchedule:
+    """
+    取该行的 CompiledSchedule：复用 db 缓存行上编译好的结果（配置修改时失效），
+    只换上 row 中推送方回写的字段；该行不在缓存中时现场编译
+    """
+    compiled = cached_schedule_object(row["id"], CompiledSchedule)
+    return compiled.with_state(row) if compiled is not None else CompiledSchedule(row)
+
+async def _delete_previous(bot, sch: CompiledSchedule):
+    # 删除上一条（相册整组删除）
+    previous = sch.previous_message_ids() if sch.remove_last else []
+    if previous:
+        try:
+            await delete_messages(bot, sch.chat_id, previous)
+        except Exception as e:
+            print(f"[scheduled_sender] 删除上一条失败: {e}")
+
+async def send_schedule(bot, sch: CompiledSchedule, pipeline: bool = SCHEDULE_PIPELINE):
+    """
+    推送单条定时消息（删除上一条、发送、置顶），返回发送出的消息列表。
+    pipeline 时删除与发送同时进行，只有置顶需要等发送完成；数据库回写由发件箱按批完成。
+    """
+    if pipeline:
+        _, messages = await asyncio.gather(_delete_previous(bot, sch), sch.send(bot))
     else:
-        # 跨天
-        return now_min >= start_min or now_min < end_min
+        await _delete_previous(bot, sch)
+        messages = await sch.send(bot)
+    # 置顶（相册置顶第一条）
+    if messages and sch.pin:
+        try:
+            await pin_message(bot, sch.chat_id, messages[0].message_id)
+        except Exception as e:
+            print(f"[scheduled_sender] 置顶失败: {e}")
+    return messages
+
+async def deliver_schedule(bot, row: dict):
+    """发件箱 kind=schedule 的发送逻辑：payload 含 schedule_id"""
+    sch_row = await fetch_schedule(row["payload"]["schedule_id"])
+    if not sch_row:
+        return None  # 入队后被删除，跳过
+    sch = compile_schedule(sch_row)
+    started = time.monotonic()
+    messages = await send_schedule(bot, sch)
+    if not messages:
+        raise RuntimeError("定时消息发送失败")
+    DELIVERY_LATENCY.record(sch.id, time.monotonic() - started, "pipelined" if SCHEDULE_PIPELINE else "sequential")
+    SEND_HISTOGRAM.record()
+    if sch.media_url and not sch.media_type:
+        # 记住探测成功的发送方式，之后每次只调用一次发送接口
+        learned = resolved_media_type(sch.media_url)
+        if learned:
+            await update_schedule_media_type(sch.id, sch.media_url, learned)
+    return [msg.message_id for msg in messages]
+
+async def write_back_message_ids(rows, message_ids):
+    """
+    每批发送完后一次性回写 last_message_id（相册另记全部消息 ID），供下次“删除上一条”使用。
+    单条消息把 last_message_ids 置空，避免改成单条后仍按旧相册删除。
+    """
+    await update_schedules_sent([
+        {
+            "id": row["payload"]["schedule_id"],
+            "last_message_id": ids[0],
+            "last_message_ids": json.dumps(ids) if len(ids) > 1 else "",
+        }
+        for row, ids in zip(rows, message_ids)
+        if ids
+    ])
+    for mode, stats in delivery_latency().items():
+        print(
+            f"[scheduled_sender] 单条推送耗时（{mode}，最近 {stats['count']} 条）："
+            f"平均 {stats['mean']:.3f}s，p50 {stats['p50']:.3f}s，p95 {stats['p95']:.3f}s",
+            flush=True
+        )
+
+register_handler("schedule", deliver_schedule, after_batch=write_back_message_ids)
+
+def plan_due(row: dict, now: datetime.datetime):
+    """
+    计算一条被认领的定时消息本轮要做的事：返回 (回写内容, 是否推送)。
+    推送交给发件箱，推送时间按入队时刻记录。
+    """
+    sch = compile_schedule(row)
+    fire_at = sch.next_fire(now)
+    update = {"id": sch.id, "claimed_fire_at": row.get("next_fire_at")}
+    send = fire_at is not None and fire_at <= now
+    if send:
+        update["last_sent_time"] = to_db_time(now)
+        sch.last_sent_time = parse_db_time(update["last_sent_time"])
+        fire_at = sch.next_fire(now)
+    update["next_fire_at"] = to_db_time(fire_at)
+    return update, send
 
-def check_in_date(now: datetime.datetime, start_date: str, end_date: str):
-    """判断当前日期是否在有效日期范围内"""
-    fmt = "%Y-%m-%d %H:%M"
-    fmt2 = "%Y-%m-%d"
+async def scheduled_sender(application, group_ids, coordinator=None):
+    """
+    定时消息后台推送任务：按下一次推送时间睡眠，每轮一次查询认领到期的定时消息。
+    传入 coordinator（ShardCoordinator）时只处理本实例分到的群。
+    """
+    queue = ScheduleQueue()
+    on_schedule_change(queue.mark_dirty)
+    if coordinator:
+        coordinator.on_change = lambda owned: queue.mark_dirty(None)
+    chat_ids = None
     try:
-        if start_date:
-            sd = datetime.datetime.strptime(start_date, fmt if " " in start_date else fmt2)
-            if now < sd:
-                return False
-        if end_date:
-            ed = datetime.datetime.strptime(end_date, fmt if " " in end_date else fmt2)
-            if now > ed:
-                return False
-        return True
-    except Exception:
-        return True
-
-async def scheduled_sender(application, group_ids):
-    """定时消息后台推送任务（推荐用数据库last_sent_time字段控制周期）"""
-    while True:
-        now = datetime.datetime.now()
-        for group_id in group_ids:
-            schedules = await fetch_schedules(group_id)
-            for sch in schedules:
-                try:
-                    # 检查启用状态
-                    if not sch.get("status"):
-                        continue
-                    # 检查时间段
-                    if not check_in_period(now, sch.get("time_period", "")):
-                        continue
-                    # 检查日期范围
-                    if not check_in_date(now, sch.get("start_date", ""), sch.get("end_date", "")):
-                        continue
-                    repeat_sec = sch.get("repeat_seconds", 0)
-                    sid = sch["id"]
-
-                    # ========== 关键点 ==========
-                    # 从数据库字段读取last_sent_time（类型建议为字符串或datetime）
-                    last_sent_time = sch.get("last_sent_time")
-                    if repeat_sec > 0 and last_sent_time:
-                        if isinstance(last_sent_time, str):
-                            try:
-                                last_sent_time = datetime.datetime.fromisoformat(last_sent_time)
-                            except Exception:
-                                last_sent_time = None
-                        if last_sent_time and (now - last_sent_time).total_seconds() < repeat_sec:
-                            continue
-
-                    # 推送内容
-                    text = sch.get("text", "")
-                    media_url = sch.get("media_url", "")
-                    media_type = sch.get("media_type", "")
-                    button_text = sch.get("button_text", "")
-                    button_url = sch.get("button_url", "")
-                    buttons = None
-                    if button_text and button_url:
-                        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-                        buttons = InlineKeyboardMarkup([[InlineKeyboardButton(button_text, url=button_url)]])
-                    # 删除上一条
-                    if sch.get("remove_last") and sch.get("last_message_id"):
-                        try:
-                            await delete_message(application.bot, group_id, sch["last_message_id"])
-                        except Exception as e:
-                            print(f"[scheduled_sender] 删除上一条失败: {e}")
-                    msg = None
-                    if media_url:
-                        msg = await send_media(application.bot, group_id, media_url, caption=text, buttons=buttons, media_type=media_type)
-                    else:
-                        if buttons:
-                            msg = await application.bot.send_message(chat_id=group_id, text=text, reply_markup=buttons)
-                        else:
-                            msg = await application.bot.send_message(chat_id=group_id, text=text)
-                    # 置顶
-                    if msg and sch.get("pin"):
-                        try:
-                            await pin_message(application.bot, group_id, msg.message_id)
-                        except Exception as e:
-                            print(f"[scheduled_sender] 置顶失败: {e}")
-                    # 更新最后推送消息ID和推送时间
-                    if msg:
-                        await update_schedule_multi(
-                            sid,
-                            last_message_id=msg.message_id,
-                            last_sent_time=now.isoformat()
-                        )
-                except Exception as e:
-                    print(f"[scheduled_sender] 定时消息推送异常: {e}")
-        await asyncio.sleep(60)
+        while True:
+            owned = coordinator.owned() if coordinator else list(group_ids)
+            if owned != chat_ids:
+                # 分到的群变化（或首次启动），重新载入这些群的推送时间
+                chat_ids = owned
+                queue.reset(await fetch_next_fire_times(chat_ids))
+            now = datetime.datetime.now()
+            lease_until = now + datetime.timedelta(seconds=SCHEDULE_CLAIM_LEASE)
+            due = await claim_due_schedules(now, lease_until, SCHEDULE_BATCH_LIMIT, chat_ids)
+            if due:
+                started = time.monotonic()
+                updates, sends = [], []
+                for row in due:
+                    update, send = plan_due(row, now)
+                    updates.append(update)
+                    if send:
+                        sends.append({"chat_id": row["chat_id"], "kind": "schedule",
+                                      "payload": {"schedule_id": row["id"]}})
+                    queue.claimed(row["id"], parse_db_time(update["next_fire_at"]))
+                # 回写推送时间与写入发件箱在同一事务中完成
+                await update_schedules_sent(updates, sends)
+                outbox.wake()
+                print(
+                    f"[scheduled_sender] 本轮处理 {len(due)} 条，入队 {len(sends)} 条 / "
+                    f"{len({item['chat_id'] for item in sends})} 个群，耗时 {time.monotonic() - started:.2f}s，"
+                    f"最近一小时每秒峰值 {SEND_HISTOGRAM.summary()['peak']} 条，"
+                    f"媒体平均每条调用 {send_media_stats()['avg_attempts']:.2f} 次接口",
+                    flush=True
+                )
+            if len(due) >= SCHEDULE_BATCH_LIMIT:
+                continue
+            queue.defer_unclaimed(now, {row["id"] for row in due})
+            timeout = queue.seconds_until_next(datetime.datetime.now())
+            if timeout is None or timeout > SCHEDULE_MAX_SLEEP:
+                timeout = SCHEDULE_MAX_SLEEP
+            elif not due:
+                # 本轮什么也没认领到时至少睡一会儿，不连续发起认领事务
+                timeout = max(timeout, SCHEDULE_MIN_SLEEP)
+            await queue.wait(timeout)
+    finally:
+        off_schedule_change(queue.mark_dirty)
+        if coordinator:
+            coordinator.on_change = None
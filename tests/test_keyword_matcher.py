@@ -0,0 +1,197 @@
+import random
+import re
+import time
+import unittest
+from modules.keyword_matcher import (
+    APPROX_MAX_DISTANCE, APPROX_MAX_LENGTH, MODE_APPROX, MODE_CONTAINS, MODE_EXACT, MODE_REGEX,
+    PREFILTER_STATS, REGEX_MAX_TEXT, AhoCorasick, DeletionIndex, KeywordMatcher, RegexSet,
+    edit_distance, prefilter_stats, validate_regex,
+)
+from modules.text_normalize import normalize
+
+class ValidateRegexTest(unittest.TestCase):
+    def test_rejects_catastrophic_patterns(self):
+        for pattern in (
+            r"(a+)+x",
+            r"(?:a*)*x",
+            r"(?:a{1,30}){1,30}x",   # 外层有上限的嵌套量词
+            r"(?:a|a){1,25}x",       # 外层有上限的重叠分支
+            r"(?:a|aa)*x",
+            r"(?:a?){1,20}x",
+            r"(?:a{1,30}){30}x",
+            r".*.*x",
+            r"\d+-\d+",
+            r"[ab]{0,10}.+\w+a+x",
+            r".+[ab]+.?x",
+        ):
+            with self.subTest(pattern=pattern):
+                self.assertIsNotNone(validate_regex(pattern))
+
+    def test_accepts_common_patterns(self):
+        for pattern in (
+            r"价格\d+元",
+            r".*优惠.*",
+            r"\d{1,10}-\d{1,10}",
+            r"(?:你好|您好).*",
+            r"^(?:hi|hello)\b",
+            r"(?:\d{3}-)+\d{4}",
+            r"(?:\d{1,3}\.){3}\d{1,3}",
+            r"(?i:free\s*money)",
+            r"https?://\S+",
+        ):
+            with self.subTest(pattern=pattern):
+                self.assertIsNone(validate_regex(pattern))
+
+    def test_accepted_patterns_fail_fast(self):
+        # 随机生成中找到的较慢写法：通过检查的，在最坏的文本上也应很快失败
+        text = "1" * REGEX_MAX_TEXT
+        for pattern in (
+            r"\w*\w{1,10}\d?x",
+            r"(?:1?\d{0,5}.{3}){3}.?x",
+            r"\d+\w{1,10}\d{3}x",
+            r"\w+?.{1,10}\w{3}a{3}x",
+        ):
+            if validate_regex(pattern):
+                continue
+            with self.subTest(pattern=pattern):
+                start = time.perf_counter()
+                re.search(pattern, text)
+                self.assertLess(time.perf_counter() - start, 0.5)
+
+# 随机测试用的小字母表：字符少才容易出现重叠、前后缀相同等边界情况；含大写和全角字母以覆盖归一化
+ALPHABET = "abcAａ "
+REGEXES = [r"a+b", r"^c", r"b.c", r"(?:ab|ca)", r"[bc]{2}", r"a$", r"(?i:CA)"]
+
+def random_text(rng, low=0, high=8):
+    return "".join(rng.choice(ALPHABET) for _ in range(rng.randint(low, high)))
+
+def naive_match(rows, text):
+    """逐条按顺序匹配，返回第一条命中的行"""
+    normalized = normalize(text)
+    for row in rows:
+        mode = row["fuzzy"]
+        if mode == MODE_REGEX:
+            if validate_regex(row["keyword"]) is None and re.search(row["keyword"], text[:REGEX_MAX_TEXT]):
+                return row
+            continue
+        keyword = normalize(row["keyword"])
+        if not keyword:
+            continue
+        if mode == MODE_APPROX and len(keyword) <= APPROX_MAX_LENGTH:
+            distance = min(row["max_distance"], APPROX_MAX_DISTANCE)
+            if edit_distance(normalized, keyword) <= distance:
+                return row
+        elif mode == MODE_CONTAINS:
+            if keyword in normalized:
+                return row
+        elif normalized == keyword:
+            return row
+    return None
+
+class AhoCorasickTest(unittest.TestCase):
+    def test_lowest_rank_wins_regardless_of_position(self):
+        automaton = AhoCorasick([("hers", 0), ("he", 1), ("she", 2), ("his", 3)])
+        self.assertEqual(automaton.search("ushers"), 0)
+        self.assertEqual(automaton.search("she"), 1)   # 后缀链接上的 he 名次更小
+        self.assertEqual(automaton.search("this"), 3)
+        self.assertIsNone(automaton.search("xyz"))
+
+    def test_matches_naive_substring_search(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            patterns = [(random_text(rng, 1, 4), rank) for rank in range(rng.randint(1, 6))]
+            automaton = AhoCorasick(patterns)
+            for _ in range(10):
+                text = random_text(rng)
+                expected = min((rank for pattern, rank in patterns if pattern in text), default=None)
+                self.assertEqual(automaton.search(text), expected, (patterns, text))
+
+class RegexSetTest(unittest.TestCase):
+    def test_rank_beats_position_in_text(self):
+        regexes = RegexSet([(r"world", 0), (r"hello", 1), (r"\d+", 2)])
+        # hello 和数字都出现得比 world 早，但 world 名次最小
+        self.assertEqual(regexes.search("123 hello world"), 0)
+        self.assertEqual(regexes.search("123 hello"), 1)
+        self.assertEqual(regexes.search("123"), 2)
+        self.assertIsNone(regexes.search("nothing"))
+
+    def test_below_limits_ranks(self):
+        regexes = RegexSet([(r"a", 0), (r"b", 3), (r"c", 5)])
+        self.assertIsNone(regexes.search("bc", below=3))
+        self.assertEqual(regexes.search("bc", below=4), 3)
+        self.assertEqual(regexes.search("ab", below=1), 0)
+
+    def test_only_searches_text_prefix(self):
+        regexes = RegexSet([(r"x", 0)])
+        self.assertIsNone(regexes.search("a" * REGEX_MAX_TEXT + "x"))
+        self.assertEqual(regexes.search("a" * (REGEX_MAX_TEXT - 1) + "x"), 0)
+
+class DeletionIndexTest(unittest.TestCase):
+    def test_matches_naive_edit_distance(self):
+        rng = random.Random(2)
+        for distance in range(1, APPROX_MAX_DISTANCE + 1):
+            for _ in range(100):
+                words = {random_text(rng, 1, 7): rank for rank in range(rng.randint(1, 5))}
+                index = DeletionIndex(words.items(), distance)
+                for _ in range(10):
+                    text = random_text(rng, 0, 9)
+                    expected = min(
+                        (rank for word, rank in words.items() if edit_distance(text, word) <= distance),
+                        default=None,
+                    )
+                    self.assertEqual(index.search(text), expected, (words, text, distance))
+
+    def test_length_window(self):
+        index = DeletionIndex([("abcdef", 0)], 2)
+        self.assertFalse(index.accepts(3))
+        self.assertTrue(index.accepts(4))
+        self.assertTrue(index.accepts(8))
+        self.assertFalse(index.accepts(9))
+
+class KeywordMatcherTest(unittest.TestCase):
+    def setUp(self):
+        PREFILTER_STATS.update(messages=0, rejected=0)
+
+    def test_matches_naive_loop(self):
+        rng = random.Random(3)
+        modes = (MODE_EXACT, MODE_CONTAINS, MODE_REGEX, MODE_APPROX)
+        for _ in range(300):
+            rows = []
+            for _ in range(rng.randint(1, 8)):
+                mode = rng.choice(modes)
+                keyword = rng.choice(REGEXES) if mode == MODE_REGEX else random_text(rng, 1, 6)
+                rows.append({"keyword": keyword, "reply": "", "fuzzy": mode,
+                             "max_distance": rng.randint(1, APPROX_MAX_DISTANCE)})
+            matcher = KeywordMatcher(rows)
+            for _ in range(20):
+                text = random_text(rng, 0, 12)
+                self.assertIs(matcher.match(text), naive_match(rows, text), (rows, text))
+
+    def test_long_approx_keyword_falls_back_to_exact(self):
+        keyword = "a" * (APPROX_MAX_LENGTH + 1)
+        matcher = KeywordMatcher([{"keyword": keyword, "reply": "", "fuzzy": MODE_APPROX, "max_distance": 1}])
+        self.assertIsNotNone(matcher.match(keyword))
+        self.assertIsNone(matcher.match(keyword[:-1]))
+
+    def test_prefilter_rejects_only_impossible_messages(self):
+        rows = [
+            {"keyword": "hello", "reply": "", "fuzzy": MODE_EXACT},
+            {"keyword": "price", "reply": "", "fuzzy": MODE_CONTAINS},
+        ]
+        matcher = KeywordMatcher(rows)
+        self.assertIsNone(matcher.match("zzz"))                 # 长度与首尾字都对不上
+        self.assertIsNone(matcher.match("what is the prize"))   # 首尾字、前两字都对得上，扫描后才确定不命中
+        self.assertIs(matcher.match("the price is"), rows[1])
+        self.assertIs(matcher.match("HELLO"), rows[0])
+        stats = prefilter_stats()
+        self.assertEqual(stats["messages"], 4)
+        self.assertEqual(stats["rejected"], 1)
+
+    def test_regex_disables_prefilter(self):
+        matcher = KeywordMatcher([{"keyword": "hello", "reply": "", "fuzzy": MODE_EXACT},
+                                  {"keyword": r"\d{3}", "reply": "", "fuzzy": MODE_REGEX}])
+        self.assertIsNone(matcher.match("zzz"))
+        self.assertEqual(prefilter_stats()["rejected"], 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import httpx
+from modules.media_cache import MediaCache
+
+# 本地 HTTP 源站：路径 -> 响应内容
+FILES = {
+    "/a.jpg": b"A" * 10,
+    "/a-copy.jpg": b"A" * 10,
+    "/b.jpg": b"B" * 10,
+    "/c.jpg": b"C" * 10,
+    "/empty.jpg": b"",
+}
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = FILES.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class MediaCacheTest(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def url(self, path):
+        return self.base + path
+
+    async def fetch(self, cache, *paths):
+        async with httpx.AsyncClient() as client:
+            return [await cache.fetch(self.url(path), client) for path in paths]
+
+    async def test_download_and_content_addressing(self):
+        cache = MediaCache(self.root, max_bytes=1024)
+        self.assertEqual(await self.fetch(cache, "/a.jpg", "/a-copy.jpg"), [True, True])
+        # 内容相同的两个 URL 只存一份
+        self.assertEqual(len(os.listdir(cache.objects)), 1)
+        self.assertEqual(cache.path_for(self.url("/a.jpg")), cache.path_for(self.url("/a-copy.jpg")))
+        upload = cache.input_file(self.url("/a.jpg"), attach=True)
+        self.assertEqual(upload.input_file_content, FILES["/a.jpg"])
+        self.assertEqual(upload.filename, "a.jpg")
+        self.assertIsNotNone(upload.attach_name)
+
+    async def test_lru_eviction(self):
+        cache = MediaCache(self.root, max_bytes=25)
+        await self.fetch(cache, "/a.jpg", "/b.jpg")
+        cache.path_for(self.url("/a.jpg"))  # a 变为最近使用
+        await self.fetch(cache, "/c.jpg")
+        self.assertIn(self.url("/a.jpg"), cache)
+        self.assertNotIn(self.url("/b.jpg"), cache)
+        self.assertIn(self.url("/c.jpg"), cache)
+        self.assertEqual(cache.usage()["evictions"], 1)
+        self.assertEqual(cache.usage()["bytes"], 20)
+
+    async def test_reload_after_restart(self):
+        cache = MediaCache(self.root, max_bytes=1024)
+        await self.fetch(cache, "/a.jpg", "/b.jpg")
+        reloaded = MediaCache(self.root, max_bytes=1024)
+        self.assertIn(self.url("/a.jpg"), reloaded)
+        self.assertIn(self.url("/b.jpg"), reloaded)
+        self.assertEqual(reloaded.usage()["bytes"], 20)
+        self.assertEqual(reloaded.input_file(self.url("/b.jpg")).input_file_content, FILES["/b.jpg"])
+
+    async def test_empty_and_missing_downloads_are_not_cached(self):
+        cache = MediaCache(self.root, max_bytes=1024)
+        self.assertEqual(await self.fetch(cache, "/empty.jpg", "/missing.jpg"), [False, False])
+        self.assertNotIn(self.url("/empty.jpg"), cache)
+        self.assertIsNone(cache.input_file(self.url("/empty.jpg")))
+        self.assertEqual(os.listdir(cache.objects), [])
+
+if __name__ == "__main__":
+    unittest.main()